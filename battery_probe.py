@@ -0,0 +1,163 @@
+import logging
+import os
+import sys
+from collections import namedtuple
+
+import psutil
+
+POWER_SUPPLY = "/sys/class/power_supply"
+READ_SIZE = 64 # Bytes read from an attribute, all the ones used are a short number or word
+
+# power in watts, energy in watt-hours, status as reported by the kernel ("Charging", "Discharging", "Full"...)
+BatteryReading = namedtuple("BatteryReading", ["percent", "plugged", "status", "power", "energy", "cycle_count"])
+
+
+def _read_attribute(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class SysfsBattery:
+    """Reads the battery and AC adapter straight from /sys/class/power_supply.
+
+    The nodes are found once and every attribute used is kept open, so a reading is one pread() per attribute instead
+    of the directory scan and file opening psutil.sensors_battery() does on every call. Besides the level and the
+    adapter it reports the power drawn, the energy left, the charge cycles and the charge state.
+
+    When the level cannot be read, e.g. after the battery was swapped or its driver rebound on resume, the nodes are
+    looked up and opened again. If the battery is gone, readings come from psutil from then on.
+    """
+
+    def __init__(self, root=POWER_SUPPLY):
+        self.root = root
+        self._fds = {}
+        self._fallback = None
+        self._open()
+
+    def _find(self):
+        battery = adapter = None
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            kind = _read_attribute(os.path.join(path, "type"))
+            # Batteries of mice and keyboards are also listed, with scope Device
+            if kind == "Battery" and battery is None and _read_attribute(os.path.join(path, "scope")) != "Device" \
+                    and _read_attribute(os.path.join(path, "present")) != "0":
+                battery = path
+            elif kind == "Mains" and adapter is None:
+                adapter = path
+        return battery, adapter
+
+    def _open(self):
+        battery, adapter = self._find()
+        if battery is None:
+            raise FileNotFoundError(f"No battery in {self.root}")
+        attributes = [(key, os.path.join(battery, key)) for key in
+                      ("capacity", "status", "energy_now", "energy_full", "charge_now", "charge_full", "power_now",
+                       "current_now", "voltage_now", "cycle_count")]
+        if adapter is not None:
+            attributes.append(("online", os.path.join(adapter, "online")))
+        for key, path in attributes:
+            try:
+                self._fds[key] = os.open(path, os.O_RDONLY)
+            except OSError:
+                pass
+        logging.info(f"Reading the battery from {battery}" + (f" and the adapter from {adapter}" if adapter else ""))
+
+    def _value(self, key):
+        fd = self._fds.get(key)
+        if fd is None:
+            return None
+        try:
+            return os.pread(fd, READ_SIZE, 0).decode().strip()
+        except OSError:
+            # Some drivers fail the read while the value is not available, e.g. power_now right after plugging
+            return None
+
+    def _number(self, key):
+        value = self._value(key)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def read(self):
+        if self._fallback is not None:
+            return self._fallback.read()
+        try:
+            return self._read()
+        except OSError as err:
+            logging.info(f"{err}, opening the battery again")
+        self.close()
+        try:
+            self._open()
+        except OSError as err:
+            logging.info(f"Falling back to psutil for the battery: {err}")
+            self._fallback = PsutilBattery()
+            return self._fallback.read()
+        return self._read()
+
+    def _read(self):
+        status = self._value("status")
+        capacity = self._number("capacity")
+        energy_now, energy_full = self._number("energy_now"), self._number("energy_full")
+        charge_now, charge_full = self._number("charge_now"), self._number("charge_full")
+        if capacity is not None:
+            percent = capacity
+        elif energy_now is not None and energy_full:
+            percent = round(100 * energy_now / energy_full)
+        elif charge_now is not None and charge_full:
+            percent = round(100 * charge_now / charge_full)
+        else:
+            raise OSError(f"Battery level not available in {self.root}")
+
+        online = self._number("online")
+        if online is not None:
+            plugged = online == 1
+        else:
+            plugged = status is not None and status.lower() != "discharging"
+
+        # sysfs uses micro units: uW, uWh, uA, uAh and uV
+        voltage = self._number("voltage_now")
+        power = self._number("power_now")
+        if power is None:
+            current = self._number("current_now")
+            if current is not None and voltage is not None:
+                power = abs(current) * voltage / 1e6
+        if energy_now is None and charge_now is not None and voltage is not None:
+            energy_now = charge_now * voltage / 1e6
+        return BatteryReading(percent, plugged, status,
+                              None if power is None else abs(power) / 1e6,
+                              None if energy_now is None else energy_now / 1e6,
+                              self._number("cycle_count"))
+
+    def close(self):
+        for fd in self._fds.values():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._fds = {}
+
+
+class PsutilBattery:
+    """Battery level and adapter state from psutil, on systems without sysfs."""
+
+    def read(self):
+        battery = psutil.sensors_battery()
+        return BatteryReading(battery.percent, battery.power_plugged, None, None, None, None)
+
+    def close(self):
+        pass
+
+
+def open_battery(root=POWER_SUPPLY):
+    """Returns the sysfs backend on Linux when it finds a battery, and the psutil one otherwise."""
+    if sys.platform.startswith("linux"):
+        try:
+            return SysfsBattery(root)
+        except OSError as err:
+            logging.info(f"Falling back to psutil for the battery: {err}")
+    return PsutilBattery()
@@ -0,0 +1,274 @@
+"""Measures the cost of each stage of the monitor loop, and of a full iteration, against local stand-ins.
+
+    python benchmark.py                               # print the results
+    python benchmark.py --save benchmark_baseline.json
+    python benchmark.py --compare benchmark_baseline.json
+
+The plug is a fake Tuya server speaking protocol 3.3 on localhost, run in a child process so that its CPU time is not
+counted, and NVML is a stub. The full iteration is monitorer.check() itself, run on an event loop with its steps on
+worker threads as in the daemon, from a temporary directory holding its parameters.json, devices.json and log. For
+every stage it reports latency percentiles, CPU time and the peak memory allocated per
+call. With --compare, it exits with status 1 if any stage got slower than the baseline by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import psutil
+import tinytuya
+
+import gpu_probe
+from battery_probe import BatteryReading, PsutilBattery, open_battery
+from plug_session import PlugSession
+from recorder import Recorder
+from sampler import Sampler
+
+LOCAL_KEY = "0123456789abcdef"
+DEVICE_ID = "benchmark00000000000"
+HEART_BEAT = 9 # Tuya command number of heartbeats, answered with an empty payload
+ALLOCATION_RUNS = 200 # Calls traced with tracemalloc, after the timed ones
+TOLERANCE = 0.25 # Relative p50 slowdown accepted by --compare
+
+
+def _recv_exact(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("client closed the connection")
+        data += chunk
+    return data
+
+
+def _serve_plug(conn):
+    cipher = tinytuya.AESCipher(LOCAL_KEY.encode())
+    state = False
+    try:
+        while True:
+            _, seqno, cmd, length = struct.unpack(">IIII", _recv_exact(conn, 16))
+            body = _recv_exact(conn, length)[:-8] # without crc and suffix
+            payload = b""
+            if cmd != HEART_BEAT:
+                if body.startswith(b"3.3"):
+                    body = body[15:]
+                request = json.loads(cipher.decrypt(body, False, decode_text=False))
+                state = request.get('dps', {}).get('1', state)
+                reply = json.dumps({"devId": DEVICE_ID, "dps": {"1": state}}).encode()
+                payload = cipher.encrypt(reply, False)
+            message = tinytuya.TuyaMessage(seqno, cmd, 0, struct.pack(">I", 0) + payload, 0, True,
+                                           tinytuya.PREFIX_55AA_VALUE, None)
+            conn.sendall(tinytuya.pack_message(message))
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        conn.close()
+
+
+def fake_plug_server(listener):
+    """Accepts connections forever, answering every command with the relay state like a real plug would."""
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=_serve_plug, args=(conn,), daemon=True).start()
+
+
+def fake_nvml(gpus=2, processes=1):
+    """Stand-in for the pynvml module with `gpus` devices, each running `processes` compute processes."""
+    class NVMLError(Exception):
+        pass
+
+    class NVMLError_NotSupported(NVMLError):
+        pass
+
+    return SimpleNamespace(
+        NVMLError=NVMLError,
+        NVMLError_NotSupported=NVMLError_NotSupported,
+        nvmlInit=lambda: None,
+        nvmlShutdown=lambda: None,
+        nvmlDeviceGetCount=lambda: gpus,
+        nvmlDeviceGetHandleByIndex=lambda index: index,
+        nvmlDeviceGetComputeRunningProcesses=lambda handle: [SimpleNamespace(pid=1000 + i) for i in range(processes)],
+        nvmlDeviceGetUtilizationRates=lambda handle: SimpleNamespace(gpu=30, memory=20),
+        nvmlDeviceGetMemoryInfo=lambda handle: SimpleNamespace(used=2 << 30, total=8 << 30),
+    )
+
+
+class ConstantBattery:
+    """Stands in for the battery of machines without one."""
+
+    def read(self):
+        return BatteryReading(60, False, None, None, None, None)
+
+    def close(self):
+        pass
+
+
+def benchmark_battery():
+    """The battery backend the daemon would use."""
+    battery = open_battery()
+    if isinstance(battery, PsutilBattery) and psutil.sensors_battery() is None:
+        # No battery in this machine, time a constant instead
+        return ConstantBattery()
+    return battery
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def measure(function, iterations, warmup=10):
+    for _ in range(warmup):
+        function()
+    latencies = []
+    cpu_start = time.process_time()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    cpu = (time.process_time() - cpu_start) / iterations
+
+    peaks = []
+    tracemalloc.start()
+    for _ in range(min(iterations, ALLOCATION_RUNS)):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        function()
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    latencies.sort()
+    peaks.sort()
+    return {
+        "p50_us": percentile(latencies, 0.5) * 1e6,
+        "p90_us": percentile(latencies, 0.9) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+        "max_us": latencies[-1] * 1e6,
+        "cpu_us": cpu * 1e6,
+        "alloc_bytes": percentile(peaks, 0.5),
+    }
+
+
+def run(iterations, plug_iterations):
+    workdir = tempfile.mkdtemp(prefix="powermonitor-bench-")
+    listener = socket.create_server(("127.0.0.1", 0))
+    server = multiprocessing.Process(target=fake_plug_server, args=(listener,), daemon=True)
+    server.start()
+    config = {"name": "benchmark", "id": DEVICE_ID, "ip": "127.0.0.1", "key": LOCAL_KEY,
+              "port": listener.getsockname()[1]}
+    gpu_probe.pynvml = fake_nvml()
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "parameters.json")) as f:
+        parameters = json.load(f)
+    parameters["DEVICE_NAME"] = "benchmark"
+    with open(os.path.join(workdir, "parameters.json"), "w") as f:
+        json.dump(parameters, f)
+    with open(os.path.join(workdir, "devices.json"), "w") as f:
+        json.dump([config], f)
+    results = {}
+    cwd = os.getcwd()
+    loop = asyncio.new_event_loop()
+    try:
+        # monitorer opens its log and looks for parameters.json and devices.json in the working directory it is
+        # imported from
+        os.chdir(workdir)
+        import monitorer
+
+        monitorer.WATCHER.check()
+        monitorer.BATTERY = benchmark_battery()
+        monitorer.SAMPLER = Sampler(monitorer.get_battery_level, monitorer.GPU.sample, monitorer.LOAD_WINDOW)
+        monitorer.RECORDER = Recorder(os.path.join(workdir, "history.bin"), capacity=1024)
+        plug = PlugSession("benchmark", lambda: config)
+
+        def connect():
+            session = PlugSession("benchmark", lambda: config)
+            session.turn(True)
+            session.close()
+
+        toggle = [False]
+
+        def command():
+            toggle[0] = not toggle[0]
+            plug.turn(toggle[0])
+
+        async def check():
+            # The body of monitorer.monitor() without its sleep
+            monitorer.get_parameters()
+            monitorer.STEPS.begin()
+            return await monitorer.check()
+
+        def iteration():
+            loop.run_until_complete(check())
+
+        stages = [
+            ("config_reload", monitorer.WATCHER.check, iterations),
+            ("battery_read", monitorer.BATTERY.read, iterations),
+            ("cpu_sample", monitorer.SAMPLER.sample, iterations),
+            ("nvml_probe", monitorer.GPU.sample, iterations),
+            ("plug_connect", connect, plug_iterations),
+            ("plug_command", command, plug_iterations),
+            ("iteration", iteration, iterations),
+        ]
+        for name, function, count in stages:
+            results[name] = measure(function, count)
+        plug.close()
+        # Turns the daemon's plug off and closes its session, its steps and its ring files
+        monitorer.on_shutdown()
+        monitorer.SAMPLER.close()
+        monitorer.BATTERY.close()
+        monitorer.LOGGER.stop()
+    finally:
+        loop.close()
+        os.chdir(cwd)
+        server.terminate()
+        listener.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_results(results, baseline=None):
+    print(f"{'stage':<15}{'p50 us':>10}{'p90 us':>10}{'p99 us':>10}{'max us':>10}{'cpu us':>10}{'alloc B':>10}")
+    for name, stats in results.items():
+        line = (f"{name:<15}{stats['p50_us']:>10.1f}{stats['p90_us']:>10.1f}{stats['p99_us']:>10.1f}"
+                f"{stats['max_us']:>10.1f}{stats['cpu_us']:>10.1f}{stats['alloc_bytes']:>10}")
+        if baseline and name in baseline:
+            line += f"  ({stats['p50_us'] / baseline[name]['p50_us'] - 1:+.0%} p50)"
+        print(line)
+
+
+def regressions(results, baseline, tolerance=TOLERANCE):
+    return [name for name, stats in results.items()
+            if name in baseline and stats['p50_us'] > baseline[name]['p50_us'] * (1 + tolerance)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the monitor loop")
+    parser.add_argument("--iterations", type=int, default=2000, help="calls timed per local stage")
+    parser.add_argument("--plug-iterations", type=int, default=200, help="calls timed per plug stage")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against the results saved in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="accepted relative p50 slowdown")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    results = run(args.iterations, args.plug_iterations)
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4)
+    if baseline:
+        slower = regressions(results, baseline, args.tolerance)
+        if slower:
+            print(f"Slower than the baseline: {', '.join(slower)}")
+            sys.exit(1)
@@ -0,0 +1,186 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+import metrics
+
+POLL_INTERVAL = 1 # Seconds between checks when inotify is not available
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_EVENT = struct.Struct("iIII")
+
+NUMBER = (int, float)
+SCHEMA = {
+    'SLEEP_TIME': NUMBER,
+    'INIT_WAIT_TIME': NUMBER,
+    'LOW_THRESHOLD': NUMBER,
+    'HIGH_THRESHOLD': NUMBER,
+    'DEVICE_NAME': str,
+    'FLUSH_PERIOD': NUMBER,
+    'MAX_RETRIES': int,
+    'GPU_PROCESS_THRESHOLD': int,
+    'ALWAYS_ON': bool,
+    'HOLD': bool,
+    'SCAN_TIME': NUMBER,
+    'SCAN_CACHE_TTL': NUMBER,
+    'LOAD_WINDOW': int,
+    'LOAD_THRESHOLD': NUMBER,
+    'MIN_SLEEP_TIME': NUMBER,
+    'MAX_SLEEP_TIME': NUMBER,
+    'LOG_MAX_BYTES': int,
+    'LOG_BACKUPS': int,
+    'LOG_JSON': bool,
+    'PLUG_VERIFY_INTERVAL': NUMBER,
+    'METRICS_PORT': (int, type(None)),
+    'MAX_BACKOFF': NUMBER,
+    'RETRY_BUDGET': int,
+    'METER_INTERVAL': NUMBER,
+    'ITERATION_DEADLINE': NUMBER,
+}
+REQUIRED = ('DEVICE_NAME',) # Keys a parameters.json of a single machine must have
+
+
+def validate_parameters(parameters, required=REQUIRED):
+    if not isinstance(parameters, dict):
+        raise ValueError("parameters must be a JSON object")
+    for key in required:
+        if key not in parameters:
+            raise ValueError(f"{key} is required")
+    for key, value in parameters.items():
+        expected = SCHEMA.get(key)
+        if expected is None:
+            continue
+        # bool is a subclass of int, but true/false is never a valid number here
+        if not isinstance(value, expected) or (expected is not bool and isinstance(value, bool)):
+            raise ValueError(f"{key} has invalid value {value!r}")
+    low = parameters.get('LOW_THRESHOLD', 0)
+    high = parameters.get('HIGH_THRESHOLD', 100)
+    if not 0 <= low < high <= 100:
+        raise ValueError(f"thresholds must satisfy 0 <= LOW_THRESHOLD < HIGH_THRESHOLD <= 100, got {low} and {high}")
+
+
+def _inotify(directory):
+    """Returns an inotify descriptor watching `directory`, or None where inotify is not available."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _names(data):
+    offset = 0
+    while offset < len(data):
+        _, _, _, length = IN_EVENT.unpack_from(data, offset)
+        offset += IN_EVENT.size
+        yield os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+        offset += length
+
+
+class ConfigWatcher:
+    """Reloads parameters.json in a background thread only when the file changes.
+
+    Changes are detected with inotify on Linux and by comparing mtime and size elsewhere. A new file is validated
+    before it replaces `parameters`, so readers always see a complete, valid configuration. `changed` is set after
+    every accepted change so that a sleeping loop can wake up early. Any object with the set/clear/wait methods of
+    threading.Event can be passed as `changed`, such as a wakeup.Wakeup shared with other event sources. A file
+    missing one of the `required` keys is rejected.
+    """
+
+    def __init__(self, path, poll_interval=POLL_INTERVAL, changed=None, required=REQUIRED):
+        self.path = os.path.abspath(path)
+        self.poll_interval = poll_interval
+        self.required = required
+        self.parameters = {}
+        self.changed = changed or threading.Event()
+        self._signature = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def check(self, force=False):
+        """Reloads the file if it changed since the last check. Returns True if new parameters were applied."""
+        signature = self._stat()
+        if signature is None or (signature == self._signature and not force):
+            return False
+        self._signature = signature
+        start = time.perf_counter()
+        try:
+            with open(self.path) as f:
+                parameters = json.load(f)
+            validate_parameters(parameters, self.required)
+        except (OSError, ValueError) as err:
+            logging.info(f"Ignoring invalid {os.path.basename(self.path)}: {err}")
+            return False
+        finally:
+            metrics.CONFIG_RELOAD.observe(time.perf_counter() - start)
+
+        old = self.parameters
+        changed = sorted(key for key in old.keys() | parameters.keys() if old.get(key) != parameters.get(key))
+        if not changed:
+            return False
+        for key in changed:
+            logging.info(f"Parameter {key}: {old.get(key)} -> {parameters.get(key)}")
+        self.parameters = parameters
+        self.changed.set()
+        return True
+
+    def _run(self, fd):
+        name = os.path.basename(self.path)
+        try:
+            while not self._stop.is_set():
+                if fd is None:
+                    self._stop.wait(self.poll_interval)
+                    self.check()
+                    continue
+                ready, _, _ = select.select([fd], [], [], self.poll_interval)
+                if ready and name in _names(os.read(fd, 4096)):
+                    self.check(force=True)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        # Watch before the first load, so a write in between is not missed
+        fd = _inotify(os.path.dirname(self.path))
+        self.check()
+        # The initial load is not a change anyone needs to wake up for
+        self.changed.clear()
+        self._thread = threading.Thread(target=self._run, args=(fd,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def wait(self, timeout):
+        """Sleeps up to `timeout` seconds, returning early if the parameters change."""
+        if self.changed.wait(timeout):
+            self.changed.clear()
+            return True
+        return False
@@ -0,0 +1,187 @@
+"""Local control API of the daemon, and its command line client.
+
+    python control.py status
+    python control.py hold on
+    python control.py always-on off
+    python control.py clear
+    python control.py heap
+
+The daemon listens on a Unix domain socket next to this file, or on a named pipe on Windows. Requests and replies are
+JSON objects. `status` is answered from the daemon's memory, without reading any file or talking to the plug.
+Overrides of HOLD and ALWAYS_ON take precedence over parameters.json until they are cleared or the daemon restarts.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+from multiprocessing.connection import Client, Listener
+
+ADDRESS = r'\\.\pipe\powermonitor' if os.name == "nt" else os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "powermonitor.sock")
+OVERRIDABLE = ('HOLD', 'ALWAYS_ON')
+MAX_REQUEST = 64 * 1024 # Largest request accepted, in bytes
+REQUEST_TIMEOUT = 5 # Seconds a client has to send its request once connected
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlServer:
+    """Serves the control requests from a background thread.
+
+    `on_change` is called with no arguments after an override is set or cleared, so the daemon can apply it at once.
+    Other commands are added with `command(name, function)`, the function takes the request arguments and returns a
+    JSON serializable reply.
+    """
+
+    def __init__(self, address=ADDRESS, on_change=None):
+        self.address = address
+        self.on_change = on_change
+        self.overrides = {}
+        self.commands = {"set": self._set, "clear": self._clear, "overrides": lambda: dict(self.overrides)}
+        self._listener = None
+        self._thread = None
+
+    def command(self, name, function):
+        self.commands[name] = function
+
+    def _set(self, name, value):
+        if name not in OVERRIDABLE:
+            raise ControlError(f"{name} cannot be overridden, only {', '.join(OVERRIDABLE)}")
+        if not isinstance(value, bool):
+            raise ControlError(f"{name} must be true or false")
+        logging.info(f"Override {name}: {self.overrides.get(name)} -> {value}")
+        self.overrides[name] = value
+        if self.on_change is not None:
+            self.on_change()
+        return dict(self.overrides)
+
+    def _clear(self, name=None):
+        names = list(self.overrides) if name is None else [name]
+        for key in names:
+            if self.overrides.pop(key, None) is not None:
+                logging.info(f"Override {key} cleared")
+        if self.on_change is not None:
+            self.on_change()
+        return dict(self.overrides)
+
+    def handle(self, request):
+        """Runs one request and returns the reply, {"ok": true, "result": ...} or {"ok": false, "error": ...}."""
+        try:
+            if not isinstance(request, dict) or request.get("command") not in self.commands:
+                raise ControlError(f"Unknown command, expected one of {', '.join(sorted(self.commands))}")
+            arguments = request.get("arguments", {})
+            if not isinstance(arguments, dict):
+                raise ControlError("arguments must be an object")
+            return {"ok": True, "result": self.commands[request["command"]](**arguments)}
+        except (ControlError, TypeError) as err:
+            return {"ok": False, "error": str(err)}
+
+    def _serve(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                # Closed by stop()
+                if self._listener is None:
+                    return
+                continue
+            try:
+                with conn:
+                    if not conn.poll(REQUEST_TIMEOUT):
+                        continue
+                    try:
+                        request = json.loads(conn.recv_bytes(MAX_REQUEST))
+                    except (OSError, ValueError) as err:
+                        conn.send_bytes(json.dumps({"ok": False, "error": f"Bad request: {err}"}).encode())
+                        continue
+                    conn.send_bytes(json.dumps(self.handle(request), default=str).encode())
+            except (EOFError, OSError) as err:
+                logging.info(f"Control client went away: {err}")
+            except Exception as ex:
+                logging.info(f"Control request failed: {ex}")
+
+    def _listen(self):
+        if os.name != "nt" and os.path.exists(self.address):
+            # Left behind by a daemon that did not exit cleanly, unless one is still running
+            try:
+                Client(self.address).close()
+            except ConnectionRefusedError:
+                os.unlink(self.address)
+            except Exception:
+                pass
+        if os.name == "nt":
+            return Listener(self.address)
+        # Only the user running the daemon may connect
+        umask = os.umask(0o177)
+        try:
+            return Listener(self.address)
+        finally:
+            os.umask(umask)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        try:
+            self._listener = self._listen()
+        except OSError as err:
+            logging.info(f"Control socket not available: {err}")
+            return
+        self._thread = threading.Thread(target=self._serve, name="control", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+
+
+def request(command, address=ADDRESS, **arguments):
+    """Sends one request to the daemon and returns the result, raising ControlError if it failed."""
+    with Client(address) as conn:
+        conn.send_bytes(json.dumps({"command": command, "arguments": arguments}).encode())
+        reply = json.loads(conn.recv_bytes())
+    if not reply.get("ok"):
+        raise ControlError(reply.get("error"))
+    return reply.get("result")
+
+
+def _switch(value):
+    if value not in ("on", "off"):
+        raise argparse.ArgumentTypeError("expected on or off")
+    return value == "on"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query and control the running power monitor")
+    parser.add_argument("--address", default=ADDRESS, help="control socket or pipe of the daemon")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="show what the daemon is doing")
+    heap = commands.add_parser("heap", help="dump a tracemalloc snapshot of the daemon and show its top allocations")
+    heap.add_argument("--top", type=int, default=20, help="allocation sites shown")
+    for name in ("hold", "always-on"):
+        sub = commands.add_parser(name, help=f"override {name.upper().replace('-', '_')}")
+        sub.add_argument("value", type=_switch, help="on or off")
+    clear = commands.add_parser("clear", help="drop overrides and go back to parameters.json")
+    clear.add_argument("name", nargs="?", choices=OVERRIDABLE, help="only this one")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "status":
+            result = request("status", args.address)
+        elif args.command == "heap":
+            result = request("heap", args.address, top=args.top)
+        elif args.command == "clear":
+            result = request("clear", args.address, name=args.name)
+        else:
+            result = request("set", args.address, name=args.command.upper().replace('-', '_'), value=args.value)
+    except (OSError, EOFError) as err:
+        print(f"Could not reach the daemon at {args.address}: {err}", file=sys.stderr)
+        sys.exit(1)
+    except ControlError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(result, indent=4, default=str))
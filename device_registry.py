@@ -0,0 +1,176 @@
+"""devices.json held in memory, indexed by device id, name and IP address.
+
+Network scans are merged into the known entries instead of replacing them: a device seen again keeps its name and
+local key and only gets its new address, version and last seen time, and devices missing from a partial scan are kept.
+The file is only written when something changed, through a temporary file renamed over it, so a crash never leaves
+it half written.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+SEEN_RESOLUTION = 60 * 60 # Seconds by which a last seen time must move before it alone is worth writing the file
+# Fields of a scan result stored in the registry, a scan never overwrites the name and key of a known device
+SCANNED = ('ip', 'version', 'productKey')
+
+
+class DeviceRegistry:
+    """Lookups by `get(name)`, `by_id(id)` and `by_ip(address)` return a copy of the entry, or None.
+
+    The file is read again when its modification time or size changed, so it can still be edited by hand while the
+    daemon runs. All methods can be called from any thread.
+    """
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.writes = 0 # Times the file was written
+        self._devices = [] # Entries in file order
+        self._by_id = {}
+        self._by_name = {}
+        self._by_ip = {}
+        self._signature = None
+        self._saved_seen = {} # Last seen time of every device as written in the file
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def _index(self):
+        self._by_id = {device['id']: device for device in self._devices if device.get('id')}
+        self._by_name = {device['name']: device for device in self._devices if device.get('name')}
+        self._by_ip = {device['ip']: device for device in self._devices if device.get('ip')}
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def load(self):
+        """Reads the file if it changed since it was last read or written. Returns True if it was read."""
+        with self._lock:
+            signature = self._stat()
+            if signature is None or signature == self._signature:
+                return False
+            try:
+                with open(self.path) as f:
+                    devices = json.load(f)
+                if not isinstance(devices, list):
+                    raise ValueError("expected a list of devices")
+            except (OSError, ValueError) as err:
+                logging.info(f"Could not read {self.path}: {err}")
+                return False
+            self._devices = [dict(device) for device in devices if isinstance(device, dict)]
+            self._signature = signature
+            self._saved_seen = {device.get('id'): device.get('last_seen') for device in self._devices}
+            self._dirty = False
+            self._index()
+            return True
+
+    def _lookup(self, index, key):
+        with self._lock:
+            self.load()
+            device = getattr(self, index).get(key)
+            return None if device is None else dict(device)
+
+    def get(self, name):
+        return self._lookup("_by_name", name)
+
+    def by_id(self, dev_id):
+        return self._lookup("_by_id", dev_id)
+
+    def by_ip(self, address):
+        return self._lookup("_by_ip", address)
+
+    def __len__(self):
+        with self._lock:
+            self.load()
+            return len(self._devices)
+
+    def devices(self):
+        """Copies of every entry, in file order."""
+        with self._lock:
+            self.load()
+            return [dict(device) for device in self._devices]
+
+    def _seen(self, device, now):
+        device['last_seen'] = now
+        saved = self._saved_seen.get(device['id'])
+        if saved is None or now - saved >= SEEN_RESOLUTION:
+            self._dirty = True
+
+    def merge(self, found, now=None):
+        """Merges scan results, dicts like those of tinytuya's scanner, into the registry and saves it if it changed.
+
+        Returns the number of new devices.
+        """
+        now = self.clock() if now is None else now
+        added = 0
+        with self._lock:
+            self.load()
+            for result in found:
+                dev_id = result.get('gwId') or result.get('id')
+                if not dev_id:
+                    continue
+                device = self._by_id.get(dev_id)
+                if device is None:
+                    device = {'id': dev_id}
+                    self._devices.append(device)
+                    self._by_id[dev_id] = device
+                    added += 1
+                    self._dirty = True
+                for key in SCANNED:
+                    if result.get(key) is not None and device.get(key) != result[key]:
+                        device[key] = result[key]
+                        self._dirty = True
+                # Scans only know the name and key of devices listed in tinytuya's own devices.json
+                for key in ('name', 'key'):
+                    if result.get(key) and not device.get(key):
+                        device[key] = result[key]
+                        self._dirty = True
+                self._seen(device, now)
+            self._index()
+            self.save()
+        if added:
+            logging.info(f"Found {added} new devices")
+        return added
+
+    def update(self, dev_id, now=None, **fields):
+        """Sets fields of a known device, such as its new ip, and saves the registry if they changed."""
+        now = self.clock() if now is None else now
+        with self._lock:
+            self.load()
+            device = self._by_id.get(dev_id)
+            if device is None:
+                return False
+            for key, value in fields.items():
+                if device.get(key) != value:
+                    device[key] = value
+                    self._dirty = True
+            self._seen(device, now)
+            self._index()
+            self.save()
+            return True
+
+    def save(self):
+        """Writes the registry if it changed since it was read, to a temporary file then renamed over devices.json."""
+        with self._lock:
+            if not self._dirty:
+                return False
+            temporary = f"{self.path}.tmp"
+            try:
+                with open(temporary, "w") as f:
+                    json.dump(self._devices, f, default=str, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporary, self.path)
+            except OSError as err:
+                logging.info(f"Could not write {self.path}: {err}")
+                return False
+            self._signature = self._stat()
+            self._saved_seen = {device.get('id'): device.get('last_seen') for device in self._devices}
+            self._dirty = False
+            self.writes += 1
+            return True
@@ -0,0 +1,104 @@
+import logging
+import socket
+import threading
+import time
+
+import metrics
+
+TUYA_PORT = 6668 # TCP port every Tuya device listens on for local commands
+SCAN_TIME = 10 # Upper bound, in seconds, for all scanning done by a single rediscovery
+SCAN_CACHE_TTL = 300 # Seconds a scan result (found or not) is reused before scanning again
+PROBE_TIMEOUT = 1 # Seconds to wait for the last known address to accept a connection
+ALL_DEVICES = "*" # Cache key of full network scans
+
+
+def probe(address, timeout=PROBE_TIMEOUT):
+    try:
+        with socket.create_connection((address, TUYA_PORT), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+class Rediscovery:
+    """Finds a plug again after it stopped answering, without flooding the network with broadcast scans.
+
+    A lookup first probes the last known address, then listens only for the wanted device id, and never spends
+    more than `scan_time` seconds in total. Every outcome, including "not found", is cached for `ttl` seconds.
+    It can be shared by threads looking for different plugs: only one broadcast scan runs at a time, and every device
+    it happens to see is cached, so lookups that waited for it usually need no scan of their own.
+    """
+
+    def __init__(self, scan_time=SCAN_TIME, ttl=SCAN_CACHE_TTL):
+        self.scan_time = scan_time
+        self.ttl = ttl
+        self.scans = 0 # Broadcast scans actually run, cache hits and successful probes excluded
+        self._cache = {}
+        self._scan_lock = threading.Lock()
+
+    def _cached(self, key):
+        entry = self._cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return True, entry[1]
+        return False, None
+
+    def _store(self, key, value):
+        self._cache[key] = (time.monotonic(), value)
+        return value
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
+
+    def find(self, dev_id, last_ip=None):
+        """Returns the current address of `dev_id`, or None if it could not be found."""
+        hit, address = self._cached(dev_id)
+        if hit:
+            logging.info(f"Using cached discovery result for {dev_id}: {address}")
+            return address
+
+        deadline = time.monotonic() + self.scan_time
+        if last_ip and probe(last_ip, min(PROBE_TIMEOUT, self.scan_time)):
+            return self._store(dev_id, last_ip)
+
+        if not self._scan_lock.acquire(timeout=max(0, deadline - time.monotonic())):
+            logging.info(f"Gave up waiting for another scan to look for {dev_id}")
+            return None
+        try:
+            # Another thread may have seen the device while this one waited for the lock
+            hit, address = self._cached(dev_id)
+            if hit:
+                return address
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                self.scans += 1
+                metrics.SCANS.inc()
+                from tinytuya import scanner
+
+                found = scanner.devices(verbose=False, scantime=remaining, poll=False, byID=True, wantids=(dev_id,))
+                for found_id, device in found.items():
+                    self._store(found_id, device.get('ip'))
+        finally:
+            self._scan_lock.release()
+        hit, address = self._cached(dev_id)
+        if address is None:
+            logging.info(f"Device {dev_id} not found on the network")
+        return self._store(dev_id, address)
+
+    def scan_all(self):
+        """Bounded full network scan, keyed by ip like tinytuya.deviceScan()."""
+        with self._scan_lock:
+            hit, devices = self._cached(ALL_DEVICES)
+            if hit:
+                return devices
+            self.scans += 1
+            metrics.SCANS.inc()
+            from tinytuya import scanner
+
+            devices = scanner.devices(verbose=False, scantime=self.scan_time, poll=False)
+            for device in devices.values():
+                if 'gwId' in device:
+                    self._store(device['gwId'], device.get('ip'))
+            return self._store(ALL_DEVICES, devices)
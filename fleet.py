@@ -0,0 +1,133 @@
+"""Agent of the fleet mode, pushing the samples of this machine to a fleet controller.
+
+    python fleet.py --controller http://lab-server:8765 --plug esmarto
+
+The agent only reads the battery, CPU, memory and GPUs, the controller (fleet_controller.py) decides for every machine
+and drives the plugs. The agent wakes up as soon as the charger is plugged or unplugged, and otherwise pushes again
+after the interval the controller answers with.
+"""
+import argparse
+import json
+import logging
+import signal
+import socket
+import urllib.request
+
+from battery_probe import open_battery
+from gpu_probe import GpuProbe, GpuSample
+from log_pipeline import setup_logging
+from sampler import LOAD_WINDOW, Sample, Sampler
+from wakeup import PowerSupplyEvents, Wakeup
+
+SLEEP_TIME = 60 # Seconds between pushes while the controller cannot be reached
+REQUEST_TIMEOUT = 5 # Seconds to wait for the controller to answer a push
+TOKEN_HEADER = "X-Fleet-Token"
+NUMBER = (int, float)
+# Types of the fields of a pushed sample, checked before the controller decides on it
+FIELDS = {
+    "time": NUMBER,
+    "battery": NUMBER,
+    "plugged": bool,
+    "cpu": NUMBER,
+    "memory": NUMBER,
+    "cpu_average": NUMBER,
+    "memory_average": NUMBER,
+    "power": NUMBER + (type(None),),
+    "energy": NUMBER + (type(None),),
+}
+
+
+def encode_sample(agent, plug, sample):
+    """JSON body of a push: the agent, the plug that charges it and its sample."""
+    body = sample._asdict()
+    body["gpus"] = [list(gpu) for gpu in sample.gpus]
+    return json.dumps({"agent": agent, "plug": plug, "sample": body}).encode()
+
+
+def _check_type(key, value, expected):
+    # bool is a subclass of int, but true/false is never a valid number here
+    if not isinstance(value, expected) or (expected is not bool and isinstance(value, bool)):
+        raise ValueError(f"Malformed sample: {key} has invalid value {value!r}")
+
+
+def decode_sample(data):
+    """Returns the (agent, plug, sample) of a push, raising ValueError if it is malformed."""
+    try:
+        push = json.loads(data)
+        body = dict(push["sample"])
+        body["gpus"] = [GpuSample(*gpu) for gpu in body.get("gpus", [])]
+        body.setdefault("power", None)
+        body.setdefault("energy", None)
+        sample = Sample(**body)
+        agent, plug = str(push["agent"]), str(push["plug"])
+    except (KeyError, TypeError) as err:
+        raise ValueError(f"Malformed sample: {err}") from err
+    for key, expected in FIELDS.items():
+        _check_type(key, getattr(sample, key), expected)
+    for gpu in sample.gpus:
+        for key, value in gpu._asdict().items():
+            _check_type(f"gpus.{key}", value, NUMBER)
+    return agent, plug, sample
+
+
+class FleetAgent:
+    def __init__(self, controller, plug, name=None, token=None, load_window=LOAD_WINDOW):
+        self.url = controller.rstrip("/") + "/samples"
+        self.plug = plug
+        self.name = name or socket.gethostname()
+        self.token = token
+        self.battery = open_battery()
+        self.gpu = GpuProbe()
+        self.sampler = Sampler(self.battery.read, self.gpu.sample, load_window)
+        self.wakeup = Wakeup()
+        self.events = PowerSupplyEvents(self.wakeup)
+
+    def push(self, sample):
+        """Sends a sample to the controller and returns its answer: the action taken and the seconds to the next push."""
+        request = urllib.request.Request(self.url, encode_sample(self.name, self.plug, sample),
+                                         {"Content-Type": "application/json"})
+        if self.token:
+            request.add_header(TOKEN_HEADER, self.token)
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            return json.load(response)
+
+    def run(self):
+        self.events.start()
+        logging.info(f"Pushing samples of {self.name} to {self.url}")
+        while not self.wakeup.stopped:
+            interval = SLEEP_TIME
+            try:
+                sample = self.sampler.sample()
+                reply = self.push(sample)
+                interval = reply.get("next", interval)
+                logging.info(f"battery is {sample.battery}, plug {self.plug} action {reply.get('action')}")
+            except (OSError, ValueError) as err:
+                logging.info(f"Could not push to the controller: {err}")
+            reasons = self.wakeup.wait(interval)
+            if reasons:
+                logging.info(f"Woken up by {', '.join(sorted(reasons))}")
+        self.close()
+
+    def stop(self):
+        self.wakeup.stop()
+
+    def close(self):
+        self.events.stop()
+        self.sampler.close()
+        self.gpu.close()
+        self.battery.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Push the samples of this machine to a fleet controller")
+    parser.add_argument("--controller", required=True, help="URL of the controller, e.g. http://lab-server:8765")
+    parser.add_argument("--plug", required=True, help="name in devices.json of the plug that charges this machine")
+    parser.add_argument("--name", help="name of this machine, the hostname by default")
+    parser.add_argument("--token", help="shared secret expected by the controller")
+    parser.add_argument("--log", default="fleetAgent.log", help="log file")
+    args = parser.parse_args()
+
+    logger = setup_logging(args.log)
+    agent = FleetAgent(args.controller, args.plug, args.name, args.token)
+    signal.signal(signal.SIGTERM, lambda signum, frame: agent.stop())
+    agent.run()
@@ -0,0 +1,349 @@
+"""Controller of the fleet mode, deciding for every machine of the fleet and driving all their plugs.
+
+    python fleet_controller.py --port 8765
+
+Agents (fleet.py) push their samples over HTTP to /samples. The controller runs the same charge policy as
+monitorer.py for each of them, using its own parameters.json for the thresholds, and answers with the action taken
+and when to push again. Plug commands run on a bounded pool of worker threads, all plugs share one discovery cache and
+one keepalive thread, so the controller does not need a thread per plug. /agents lists the last sample and action of
+every agent, /plugs the state and circuit breaker of every plug, and /metrics serves the metrics of the controller.
+"""
+import argparse
+import hmac
+import ipaddress
+import json
+import logging
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+from config_watcher import ConfigWatcher
+from device_registry import DeviceRegistry
+from discovery import Rediscovery
+from fleet import TOKEN_HEADER, decode_sample
+from log_pipeline import setup_logging
+from plug_session import KEEPALIVE_INTERVAL, PlugError, PlugSession
+from policy import LOAD_THRESHOLD, decide, is_consuming
+from resilience import Backoff, CircuitBreaker, RetryBudget
+from scheduler import SleepScheduler
+
+PORT = 8765
+WORKERS = 16 # Plug commands in flight at once, whatever the size of the fleet
+KEEPALIVE_WORKERS = 2 # Heartbeats in flight at once, apart from the commands so unreachable plugs cannot delay them
+MAX_BODY = 64 * 1024 # Largest push accepted, in bytes
+
+# Used when parameters.json leaves them out
+DEFAULTS = {
+    'LOW_THRESHOLD': 25,
+    'HIGH_THRESHOLD': 80,
+    'SLEEP_TIME': 60,
+    'MIN_SLEEP_TIME': 10,
+    'MAX_SLEEP_TIME': 600,
+    'GPU_PROCESS_THRESHOLD': 1,
+    'LOAD_THRESHOLD': LOAD_THRESHOLD,
+    'PLUG_VERIFY_INTERVAL': 600,
+    'MAX_RETRIES': 5,
+    'MAX_BACKOFF': 60 * 30,
+    'RETRY_BUDGET': 10,
+    'SCAN_TIME': 10,
+    'SCAN_CACHE_TTL': 300,
+    'ALWAYS_ON': False,
+    'HOLD': False,
+}
+
+
+class PlugPool:
+    """One persistent PlugSession per plug of the fleet.
+
+    Commands are queued on a pool of `workers` threads, and a plug that still has a command in flight does not get
+    another one. Every plug has a circuit breaker, so a plug that is offline is only tried again after a backoff, and
+    all plugs share one budget of rediscoveries. A single thread schedules the heartbeats of every session on a
+    small pool of its own, skipping the plugs busy with a command. devices.json is held in a DeviceRegistry, read
+    again when it changes.
+    """
+
+    def __init__(self, devices_path, discovery, workers=WORKERS, verify_interval=DEFAULTS['PLUG_VERIFY_INTERVAL']):
+        self.registry = DeviceRegistry(devices_path)
+        self.discovery = discovery
+        self.verify_interval = verify_interval
+        self.max_retries = DEFAULTS['MAX_RETRIES'] # Consecutive failures after which a plug is left alone for a while
+        self.max_backoff = DEFAULTS['MAX_BACKOFF'] # Longest time a failing plug is left alone
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plug")
+        self._keepalive_executor = ThreadPoolExecutor(max_workers=KEEPALIVE_WORKERS, thread_name_prefix="heartbeat")
+        self._sessions = {}
+        self._pending = {}
+        self._heartbeats = {}
+        self._breakers = {}
+        self.budget = RetryBudget(DEFAULTS['RETRY_BUDGET'])
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._keepalive_thread = None
+
+    def config(self, name):
+        device = self.registry.get(name)
+        if device is None:
+            logging.info(f"Device {name} not found")
+        return device
+
+    def session(self, name):
+        with self._lock:
+            session = self._sessions.get(name)
+            if session is None:
+                session = PlugSession(name, lambda: self.config(name), verify_interval=self.verify_interval,
+                                      keepalive_thread=False)
+                self._sessions[name] = session
+            session.verify_interval = self.verify_interval
+            return session
+
+    def ensure(self, name, on, plugged=None):
+        """Queues a command putting plug `name` in the requested state. `plugged` is whether the machine it charges
+        sees its charger, see PlugSession.ensure.
+
+        Returns False if one is already in flight, or if the circuit of the plug is open.
+        """
+        with self._lock:
+            pending = self._pending.get(name)
+            if pending is not None and not pending.done():
+                return False
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(name, self.max_retries, Backoff(max_delay=self.max_backoff))
+                self._breakers[name] = breaker
+            breaker.failure_threshold = self.max_retries
+            breaker.backoff.max_delay = self.max_backoff
+            if not breaker.allow():
+                return False
+            self._pending[name] = self._executor.submit(self._ensure, name, on, breaker, plugged)
+            return True
+
+    def _ensure(self, name, on, breaker, plugged=None):
+        session = self.session(name)
+        try:
+            if session.ensure(on, plugged):
+                logging.info(f"Turned {name} {'on' if on else 'off'}")
+            breaker.success()
+        except PlugError as err:
+            logging.info(f"Could not turn {'on' if on else 'off'} {name}: {err}")
+            breaker.failure()
+            if self.budget.spend():
+                metrics.RETRIES.inc()
+                self.rediscover(name)
+        except Exception as err:
+            # Nobody waits on the future, so log it here. It still has to end the trial of a half-open circuit.
+            logging.info(f"Could not turn {'on' if on else 'off'} {name}: {err!r}")
+            breaker.failure()
+
+    def rediscover(self, name):
+        config = self.config(name)
+        if config is None:
+            return None
+        address = self.discovery.find(config['id'], config.get('ip'))
+        if address is not None and address != config.get('ip'):
+            logging.info(f"Device {name} moved to {address}")
+            self.registry.update(config['id'], ip=address)
+        return address
+
+    def status(self):
+        with self._lock:
+            sessions = dict(self._sessions)
+            breakers = dict(self._breakers)
+        return {
+            "plugs": {name: {"state": session.state, **session.stats(),
+                             "breaker": breakers[name].status() if name in breakers else None}
+                      for name, session in sessions.items()},
+            "retry_budget": self.budget.status(),
+        }
+
+    def _keepalive_loop(self):
+        while not self._stop.wait(KEEPALIVE_INTERVAL):
+            with self._lock:
+                for name, session in self._sessions.items():
+                    # A command keeps the socket alive by itself, and a heartbeat still waiting on an unreachable
+                    # plug does not need another one behind it
+                    pending, heartbeat = self._pending.get(name), self._heartbeats.get(name)
+                    if pending is not None and not pending.done() or heartbeat is not None and not heartbeat.done():
+                        continue
+                    self._heartbeats[name] = self._keepalive_executor.submit(session.heartbeat)
+
+    def start(self):
+        if self._keepalive_thread is None:
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name="plug-keepalive", daemon=True)
+            self._keepalive_thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._keepalive_executor.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        for session in self._sessions.values():
+            session.close()
+
+
+class AgentState:
+    def __init__(self, name, plug, min_interval, max_interval):
+        self.name = name
+        self.plug = plug
+        self.scheduler = SleepScheduler(min_interval, max_interval)
+        self.sample = None
+        self.action = None
+        self.seen = None
+
+
+class FleetController:
+    """Runs the charge policy for every agent from the samples they push."""
+
+    def __init__(self, pool, watcher, token=None):
+        self.pool = pool
+        self.watcher = watcher
+        self.token = token
+        self.agents = {}
+        self._lock = threading.Lock()
+
+    def parameter(self, key):
+        return self.watcher.parameters.get(key, DEFAULTS[key])
+
+    def _agent(self, name, plug):
+        with self._lock:
+            agent = self.agents.get(name)
+            if agent is None:
+                logging.info(f"New agent {name} charged by {plug}")
+                agent = AgentState(name, plug, self.parameter('MIN_SLEEP_TIME'), self.parameter('MAX_SLEEP_TIME'))
+                self.agents[name] = agent
+            agent.plug = plug
+            return agent
+
+    def handle(self, name, plug, sample):
+        """Decides for one pushed sample, queues the plug command and returns the answer for the agent."""
+        agent = self._agent(name, plug)
+        low, high = self.parameter('LOW_THRESHOLD'), self.parameter('HIGH_THRESHOLD')
+        sleep_time = self.parameter('SLEEP_TIME')
+        self.pool.verify_interval = self.parameter('PLUG_VERIFY_INTERVAL')
+        self.pool.max_retries = self.parameter('MAX_RETRIES')
+        self.pool.max_backoff = self.parameter('MAX_BACKOFF')
+        self.pool.budget.limit = self.parameter('RETRY_BUDGET')
+        self.pool.discovery.scan_time = self.parameter('SCAN_TIME')
+        self.pool.discovery.ttl = self.parameter('SCAN_CACHE_TTL')
+        agent.scheduler.min_interval = self.parameter('MIN_SLEEP_TIME')
+        agent.scheduler.max_interval = self.parameter('MAX_SLEEP_TIME')
+
+        if self.parameter('HOLD'):
+            action = None
+        elif self.parameter('ALWAYS_ON'):
+            action = True
+        else:
+            agent.scheduler.record(sample.battery, sample.plugged)
+            consuming = is_consuming(sample, self.parameter('GPU_PROCESS_THRESHOLD'), self.parameter('LOAD_THRESHOLD'))
+            action = decide(sample.battery, sample.plugged, consuming, low, high)
+        if action is not None:
+            self.pool.ensure(plug, action, sample.plugged)
+        agent.sample, agent.action, agent.seen = sample, action, time.time()
+        return {"action": action, "next": agent.scheduler.next_interval(low, high, sleep_time)}
+
+    def status(self):
+        with self._lock:
+            agents = list(self.agents.values())
+        return {agent.name: {"plug": agent.plug, "seen": agent.seen, "action": agent.action,
+                             "battery": agent.sample.battery, "plugged": agent.sample.plugged,
+                             "power": agent.sample.power} for agent in agents if agent.sample is not None}
+
+
+class FleetHandler(BaseHTTPRequestHandler):
+    controller = None # Set by serve()
+
+    def _reply(self, status, body, content_type="application/json"):
+        body = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != "/samples":
+            self.send_error(404)
+            return
+        token = self.controller.token
+        if token and not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ""), token):
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            self.send_error(400)
+            return
+        if not 0 < length <= MAX_BODY:
+            self.send_error(400)
+            return
+        try:
+            name, plug, sample = decode_sample(self.rfile.read(length))
+        except ValueError as err:
+            self.send_error(400, str(err))
+            return
+        self._reply(200, self.controller.handle(name, plug, sample))
+
+    def do_GET(self):
+        if self.path == "/agents":
+            self._reply(200, self.controller.status())
+        elif self.path == "/plugs":
+            self._reply(200, self.controller.pool.status())
+        elif self.path == "/metrics":
+            self._reply(200, metrics.render().encode(), metrics.CONTENT_TYPE)
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        # One line per push would flood the log
+        pass
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+def serve(controller, port=PORT, host="127.0.0.1"):
+    """Builds the server of the controller. Raises ValueError for an address other hosts can reach without a token."""
+    if not controller.token and not is_loopback(host):
+        raise ValueError(f"Refusing to listen on {host} without a token, anyone on the network could switch the plugs")
+    handler = type("Handler", (FleetHandler,), {"controller": controller})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decide for a fleet of machines and drive their plugs")
+    parser.add_argument("--port", type=int, default=PORT, help="port the agents push to")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on, other than loopback needs --token")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="plug commands in flight at once")
+    parser.add_argument("--token", help="shared secret the agents must send")
+    parser.add_argument("--devices", default="devices.json", help="devices.json with every plug of the fleet")
+    parser.add_argument("--parameters", default="parameters.json", help="parameters.json with the thresholds")
+    parser.add_argument("--log", default="fleetController.log", help="log file")
+    args = parser.parse_args()
+    if not args.token and not is_loopback(args.host):
+        parser.error(f"--token is required to listen on {args.host}")
+
+    logger = setup_logging(args.log)
+    # The fleet has no single DEVICE_NAME, every agent names its own plug
+    watcher = ConfigWatcher(args.parameters, required=())
+    watcher.start()
+    discovery = Rediscovery(watcher.parameters.get('SCAN_TIME', DEFAULTS['SCAN_TIME']),
+                            watcher.parameters.get('SCAN_CACHE_TTL', DEFAULTS['SCAN_CACHE_TTL']))
+    pool = PlugPool(args.devices, discovery, args.workers)
+    pool.start()
+    server = serve(FleetController(pool, watcher, args.token), args.port, args.host)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logging.info(f"Fleet controller listening on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        watcher.stop()
+        pool.close()
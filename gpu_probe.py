@@ -0,0 +1,94 @@
+import atexit
+import logging
+import time
+from collections import namedtuple
+
+import metrics
+
+RETRY_INTERVAL = 60 * 10 # Seconds to wait before trying to initialize NVML again after it failed
+
+pynvml = None # Imported by the first probe, most machines have no NVIDIA GPU and it is slow to load
+
+
+def _import_pynvml():
+    """Returns True once pynvml is imported, False if it is not installed."""
+    global pynvml
+    if pynvml is None:
+        try:
+            import pynvml as module
+        except ImportError:
+            return False
+        pynvml = module
+    return True
+
+
+GpuSample = namedtuple("GpuSample", ["index", "processes", "utilization", "memory_used", "memory_total"])
+
+
+class GpuProbe:
+    """Holds a single NVML session and the device handles for the life of the process.
+
+    If NVML is missing or fails to initialize (e.g. machines without an NVIDIA GPU), the probe reports no GPUs and
+    only tries again after `retry_interval` seconds.
+    """
+
+    def __init__(self, retry_interval=RETRY_INTERVAL):
+        self.retry_interval = retry_interval
+        self.available = False
+        self._handles = []
+        self._next_attempt = 0
+        self._registered = False
+
+    def _init(self):
+        if self.available:
+            return True
+        if time.monotonic() < self._next_attempt:
+            return False
+        if not _import_pynvml():
+            logging.info("NVML not available: pynvml is not installed")
+            self._next_attempt = time.monotonic() + self.retry_interval
+            return False
+        try:
+            pynvml.nvmlInit()
+            self._handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(pynvml.nvmlDeviceGetCount())]
+            self.available = True
+            if not self._registered:
+                atexit.register(self.close)
+                self._registered = True
+        except pynvml.NVMLError as err:
+            logging.info(f"NVML not available: {err}")
+            self._next_attempt = time.monotonic() + self.retry_interval
+        return self.available
+
+    def sample(self):
+        """Returns one GpuSample per GPU, or an empty list if NVML is not available."""
+        if not self._init():
+            return []
+        start = time.perf_counter()
+        samples = []
+        try:
+            for index, handle in enumerate(self._handles):
+                processes = pynvml.nvmlDeviceGetComputeRunningProcesses(handle)
+                try:
+                    utilization = pynvml.nvmlDeviceGetUtilizationRates(handle).gpu
+                except pynvml.NVMLError_NotSupported:
+                    utilization = None
+                memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+                samples.append(GpuSample(index, len(processes), utilization, memory.used, memory.total))
+        except pynvml.NVMLError as err:
+            # Handles go stale if the driver is reloaded, start over on a later call
+            logging.info(err)
+            self.close()
+            self._next_attempt = time.monotonic() + self.retry_interval
+            return []
+        metrics.NVML_PROBE.observe(time.perf_counter() - start)
+        return samples
+
+    def close(self):
+        if self.available:
+            self.available = False
+            self._handles = []
+            try:
+                pynvml.nvmlShutdown()
+            except pynvml.NVMLError:
+                pass
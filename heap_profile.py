@@ -0,0 +1,51 @@
+"""Heap snapshots of the running daemon, taken on demand with tracemalloc.
+
+    python control.py heap
+    kill -USR2 <pid>
+
+The first request starts tracing if the daemon was not started with PYTHONTRACEMALLOC set, so the snapshots of later
+requests only cover what was allocated since. Each snapshot is dumped next to the log, where it can be loaded with
+tracemalloc.Snapshot.load() and compared to an earlier one, and its top allocation sites are logged.
+"""
+import itertools
+import logging
+import os
+import signal
+import threading
+import time
+import tracemalloc
+
+FRAMES = 10 # Frames kept per traced allocation, enough to tell callers of the shared helpers apart
+TOP = 20 # Allocation sites reported per snapshot
+IGNORED = (tracemalloc.__file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>", "<unknown>")
+
+_numbers = itertools.count(1) # Tells apart snapshots taken within the same second
+
+
+def snapshot(directory, top=TOP):
+    """Dumps a snapshot to `directory` and returns its path, the traced memory and the `top` allocation sites.
+
+    Only starts tracing, and returns no snapshot, if it was not on yet.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(FRAMES)
+        logging.info("Started tracing allocations, request another heap snapshot later")
+        return {"tracing": "started", "path": None, "traced": 0, "top": []}
+    heap = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, name) for name in IGNORED])
+    path = os.path.join(directory, f"heap-{time.strftime('%Y%m%d-%H%M%S')}-{next(_numbers)}.tracemalloc")
+    heap.dump(path)
+    current, peak = tracemalloc.get_traced_memory()
+    sites = [str(stat) for stat in heap.statistics("lineno")[:top]]
+    logging.info(f"Heap snapshot {path}: {current / 1024:.0f} KiB traced, peak {peak / 1024:.0f} KiB")
+    for site in sites:
+        logging.info(f"  {site}")
+    return {"tracing": "on", "path": path, "traced": current, "peak": peak, "top": sites}
+
+
+def install_signal(directory, signum=getattr(signal, "SIGUSR2", None)):
+    """Takes a snapshot whenever the process gets `signum`, SIGUSR2 by default. Does nothing where it does not exist."""
+    if signum is None:
+        return
+    # The handler runs on the main thread, which may be in the middle of a check, the snapshot is taken aside
+    signal.signal(signum, lambda number, frame: threading.Thread(target=snapshot, args=(directory,),
+                                                                 name="heap-snapshot", daemon=True).start())
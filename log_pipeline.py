@@ -0,0 +1,134 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+MAX_BYTES = 1024 * 1024 # Size at which the log file is rotated
+MAX_AGE = 60 * 60 # Seconds after which the log file is rotated regardless of its size
+BACKUPS = 5 # Rotated files kept next to the current one, as monitoringLog.log.1 ... .N
+QUEUE_SIZE = 10000 # Records waiting to be written before new ones are dropped
+BATCH_SIZE = 256 # Records written between two flushes
+TEXT_FORMAT = '%(asctime)s %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the time as a unix timestamp."""
+
+    def format(self, record):
+        entry = {"time": record.created, "level": record.levelname, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RotatingHandler(logging.handlers.RotatingFileHandler):
+    """Rotates when the file reaches `maxBytes` or when it is older than `max_age` seconds."""
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, max_age=MAX_AGE, backups=BACKUPS):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        self.max_age = max_age
+        self.opened = time.time()
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        size = self.stream.tell()
+        if self.max_age and size > 0 and time.time() - self.opened >= self.max_age:
+            return True
+        return 0 < self.maxBytes <= size
+
+    def doRollover(self):
+        super().doRollover()
+        self.opened = time.time()
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            # No flush here, the writer flushes once per batch
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread without formatting them, dropping them if the queue is full."""
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter:
+    """Background thread that drains the log queue and writes records in batches."""
+
+    def __init__(self, handler, records):
+        self.handler = handler
+        self.records = records
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self.records.get()
+            batch = [record]
+            while record is not None and len(batch) < BATCH_SIZE:
+                try:
+                    record = self.records.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(record)
+            for record in batch:
+                if record is not None:
+                    self.handler.handle(record)
+            self.handler.flush()
+            if batch[-1] is None:
+                return
+
+    def configure(self, max_bytes=MAX_BYTES, max_age=MAX_AGE, backups=BACKUPS, json_lines=False):
+        handler = self.handler
+        handler.acquire()
+        try:
+            handler.maxBytes = max_bytes
+            handler.max_age = max_age
+            handler.backupCount = backups
+            if json_lines != isinstance(handler.formatter, JsonFormatter):
+                set_json_lines(handler, json_lines)
+        finally:
+            handler.release()
+
+    def stop(self):
+        if self._thread.is_alive():
+            self.records.put(None)
+            self._thread.join(timeout=5)
+        self.handler.close()
+
+
+def setup_logging(filename, max_bytes=MAX_BYTES, max_age=MAX_AGE, backups=BACKUPS, json_lines=False,
+                  level=logging.DEBUG):
+    """Routes the root logger through a queue to a rotating file written from a background thread."""
+    handler = RotatingHandler(filename, max_bytes, max_age, backups)
+    set_json_lines(handler, json_lines)
+    records = queue.Queue(QUEUE_SIZE)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(records))
+    root.setLevel(level)
+    writer = LogWriter(handler, records)
+    atexit.register(writer.stop)
+    return writer
+
+
+def set_json_lines(handler, json_lines):
+    handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(TEXT_FORMAT))
@@ -0,0 +1,135 @@
+"""Power metering of the smart plug, and a ledger of the energy used by every charge.
+
+Plugs with metering report the current, power and voltage in their DPS values, which come along with the relay
+state in the reply to a status request. Every reading is stored in a ring file like history.bin, and the readings
+taken while the relay is on are integrated into one ledger entry per charge cycle.
+"""
+import json
+import logging
+import struct
+import time
+from collections import namedtuple
+
+import metrics
+from plug_session import PlugError
+from recorder import Recorder
+
+# DPS indexes and scale of the metering values: (current in mA, power in deciwatts, voltage in decivolts).
+# Most plugs use the first layout, older firmware the second one.
+LAYOUTS = (('18', '19', '20'), ('4', '5', '6'))
+MAX_GAP = 60 * 10 # Readings further apart than this are not integrated across, the plug was probably unreachable
+LOW_EFFICIENCY = 0.5 # Charge cycles storing less than this fraction of the energy drawn are reported
+
+MeterReading = namedtuple("MeterReading", ["time", "current", "power", "voltage", "relay"]) # A, W, V
+
+
+def parse_meter(data, now):
+    """Returns the MeterReading in the reply to a status request, or None if the plug does not meter.
+
+    Raises PlugError if the reply has no DPS values at all, which says nothing about the plug's meter.
+    """
+    dps = data.get('dps') if isinstance(data, dict) else None
+    if not dps or 'Error' in data:
+        raise PlugError(f"No DPS in the reply: {data!r}")
+    for current, power, voltage in LAYOUTS:
+        if power in dps:
+            return MeterReading(now, dps.get(current, 0) / 1000, dps[power] / 10, dps.get(voltage, 0) / 10,
+                                dps.get('1'))
+    return None
+
+
+def read_meter(plug, clock=time.time):
+    """Reads the relay and the metering values of a PlugSession with a single status request."""
+    return parse_meter(plug.status(), clock())
+
+
+class MeterRecorder(Recorder):
+    """Ring file of meter readings, read back as a NumPy array like history.bin."""
+
+    magic = b"PMMT"
+    record = struct.Struct("<dfffb") # time, current, power, voltage, relay (1 on, 0 off, -1 unknown)
+    fields = [("time", "<f8"), ("current", "<f4"), ("power", "<f4"), ("voltage", "<f4"), ("relay", "i1")]
+
+    def append(self, reading, action=None):
+        self.write(reading.time, reading.current, reading.power, reading.voltage,
+                   -1 if reading.relay is None else int(reading.relay))
+
+
+class EnergyLedger:
+    """Integrates the meter readings into one entry per charge cycle, a period with the relay on.
+
+    Every closed cycle is appended as a JSON line to `path`: its duration, the energy drawn from the wall (Wh), the
+    peak and average power (W), the battery level at both ends and, when the battery reports its energy, the energy
+    stored in it and the efficiency of the charge.
+    """
+
+    def __init__(self, path, max_gap=MAX_GAP):
+        self.path = path
+        self.max_gap = max_gap
+        self.cycle = None # The cycle in progress
+        self.last = None # Last cycle closed
+        self._previous = None
+
+    def _open(self, reading, sample):
+        self.cycle = {
+            "start": reading.time,
+            "end": reading.time,
+            "energy_wh": 0.0,
+            "peak_w": reading.power,
+            "battery_start": None if sample is None else sample.battery,
+            "battery_end": None if sample is None else sample.battery,
+            "_battery_energy_start": None if sample is None else sample.energy,
+            "_battery_energy_end": None if sample is None else sample.energy,
+        }
+
+    def _close(self):
+        cycle = {key: value for key, value in self.cycle.items() if not key.startswith("_")}
+        duration = cycle["end"] - cycle["start"]
+        cycle["duration"] = duration
+        cycle["average_w"] = cycle["energy_wh"] * 3600 / duration if duration > 0 else 0.0
+        start, end = self.cycle["_battery_energy_start"], self.cycle["_battery_energy_end"]
+        stored = None if start is None or end is None else end - start
+        cycle["battery_energy_wh"] = stored
+        cycle["efficiency"] = stored / cycle["energy_wh"] if stored is not None and cycle["energy_wh"] > 0 else None
+        self.cycle = None
+        self.last = cycle
+        if cycle["efficiency"] is not None and cycle["efficiency"] < LOW_EFFICIENCY:
+            logging.info(f"Charge stored {cycle['efficiency']:.0%} of the energy drawn, the charger may be failing")
+        logging.info(f"Charge cycle: {cycle['energy_wh']:.1f} Wh in {duration / 60:.0f} min, "
+                     f"peak {cycle['peak_w']:.1f} W")
+        try:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(cycle) + "\n")
+        except OSError as err:
+            logging.info(f"Could not write {self.path}: {err}")
+        return cycle
+
+    def add(self, reading, sample=None):
+        """Accounts for one reading. `sample` is the Sample taken along with it, for the battery level and energy."""
+        metrics.PLUG_POWER.set(reading.power)
+        previous, self._previous = self._previous, reading
+        if previous is not None and reading.time - previous.time <= self.max_gap and previous.relay:
+            # Trapezoid between the two readings
+            energy = (previous.power + reading.power) / 2 * (reading.time - previous.time) / 3600
+            metrics.PLUG_ENERGY.inc(energy)
+            if self.cycle is not None:
+                self.cycle["energy_wh"] += energy
+        if reading.relay and self.cycle is None:
+            self._open(reading, sample)
+        elif self.cycle is not None:
+            self.cycle["end"] = reading.time
+            self.cycle["peak_w"] = max(self.cycle["peak_w"], reading.power)
+            # Without a sample taken along with this reading the battery at the end of the cycle is unknown, an
+            # older one would make up its efficiency
+            self.cycle["battery_end"] = None if sample is None else sample.battery
+            self.cycle["_battery_energy_end"] = None if sample is None else sample.energy
+            if not reading.relay:
+                return self._close()
+        return None
+
+    def status(self):
+        current = None
+        if self.cycle is not None:
+            current = {key: value for key, value in self.cycle.items() if not key.startswith("_")}
+        reading = self._previous
+        return {"power": None if reading is None else reading.power, "cycle": current, "last_cycle": self.last}
@@ -0,0 +1,129 @@
+"""Process-wide metrics, served in the Prometheus text format.
+
+Metrics are created once at import time and updated in place, so recording a value allocates nothing beyond the
+number itself. Stage timings use time.perf_counter(), which is monotonic.
+"""
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics = []
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return [f"{self.name} {self.value}"]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, counts):
+            cumulative += bucket
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+BATTERY_READ = Histogram("powermonitor_battery_read_seconds", "Time spent reading the battery")
+CPU_SAMPLE = Histogram("powermonitor_cpu_sample_seconds", "Time spent reading CPU and memory usage")
+NVML_PROBE = Histogram("powermonitor_nvml_probe_seconds", "Time spent reading the GPUs through NVML")
+CONFIG_RELOAD = Histogram("powermonitor_config_reload_seconds", "Time spent reloading parameters.json")
+PLUG_CONNECT = Histogram("powermonitor_plug_connect_seconds", "Time of plug commands that had to open a connection")
+PLUG_COMMAND = Histogram("powermonitor_plug_command_seconds", "Time of plug commands sent on an open connection")
+SCANS = Counter("powermonitor_scans_total", "Network scans run to find the plug")
+RETRIES = Counter("powermonitor_retries_total", "Attempts to reach the plug again after a failed command")
+BREAKER_OPENS = Counter("powermonitor_breaker_opens_total", "Times the circuit breaker of a plug opened")
+RETRIES_DENIED = Counter("powermonitor_retries_denied_total", "Retries skipped because the retry budget was spent")
+STEP_OVERRUNS = Counter("powermonitor_step_overruns_total", "Steps of a check left behind for taking too long")
+HOLDS = Counter("powermonitor_hold_transitions_total", "Times the monitor went into HOLD")
+TOGGLES = Counter("powermonitor_plug_toggles_total", "Plug commands that changed the relay state")
+BATTERY_LEVEL = Gauge("powermonitor_battery_level_percent", "Last battery level read")
+BATTERY_POWER = Gauge("powermonitor_battery_power_watts", "Last power drawn from or charged into the battery")
+PLUG_STATE = Gauge("powermonitor_plug_state", "Last confirmed relay state, 1 on, 0 off, -1 unknown")
+PLUG_STATE.set(-1)
+PLUG_POWER = Gauge("powermonitor_plug_power_watts", "Last power drawn through the plug")
+PLUG_ENERGY = Counter("powermonitor_plug_energy_watt_hours_total", "Energy drawn through the plug while metered")
+HOLD = Gauge("powermonitor_hold", "1 while HOLD is set in parameters.json or through the control socket")
+BREAKER_STATE = Gauge("powermonitor_breaker_state", "Circuit breaker of the plug, 0 closed, 1 half-open, 2 open")
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise flood the daemon's log
+        pass
+
+
+def start_server(port, host="127.0.0.1"):
+    """Serves /metrics from a daemon thread and returns the server."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -1,229 +1,422 @@
+import asyncio
 import os
 import logging
 import time
-import psutil
-import json
-import wifi
-import pynvml
-import tinytuya
-from datetime import datetime
 import sys
 import atexit
-import subprocess
+import signal
+from plug_session import PlugSession, PlugError
+from discovery import Rediscovery
+from device_registry import DeviceRegistry
+from gpu_probe import GpuProbe
+from battery_probe import open_battery
+from sampler import Sampler
+from config_watcher import ConfigWatcher
+from scheduler import SleepScheduler
+from recorder import Recorder
+from log_pipeline import setup_logging
+from policy import decide, is_consuming
+from wakeup import Wakeup, PowerSupplyEvents
+from control import ControlServer
+import heap_profile
+from readiness import network_up, plug_reachable, wait_until_ready
+from resilience import CLOSED, Backoff, CircuitBreaker, RetryBudget
+from metering import EnergyLedger, MeterRecorder, read_meter
+from steps import Steps
+import metrics
 
 PWD = os.path.dirname(os.path.abspath(__file__))
 BASEPATH = PWD if os.name == "nt" else ""
-logging.basicConfig(filename=f'{BASEPATH}monitoringLog.log', encoding='utf-8', format='%(asctime)s %(message)s',
-                    level=logging.DEBUG)
+LOGGER = setup_logging(f'{BASEPATH}monitoringLog.log')
 
 
 DEVICE_NAME = "esmarto" # Name of the Plug device
 LOW_THRESHOLD = 25 # Low bound of battery level to plug on the device
 HIGH_THRESHOLD = 80 # High bound of battery level to plug off the device
 SLEEP_TIME = 60 * 1 # Determines how much in minutes to wait in order to check the battery again
-INIT_WAIT_TIME = SLEEP_TIME * 2 # This is the initial wait time, ideally you want to wait until the device has booted up and that king of thing
-LAST_FLUSH = None # datetime storing last time the log file was flushed
+INIT_WAIT_TIME = SLEEP_TIME * 2 # Longest wait at startup for the network, the plug and the battery to be ready
 error = False # True if an unexpected error occurs, used to handle the state
-FLUSH_PERIOD = 60 # Period for flushing the log file
-MAX_RETRIES = 5 # Max retry request executions when failure
+FLUSH_PERIOD = 60 # Minutes after which the log file is rotated
+LOG_MAX_BYTES = 1024 * 1024 # Size in bytes after which the log file is rotated
+LOG_BACKUPS = 5 # Number of rotated log files kept
+LOG_JSON = False # Write the log as JSON lines instead of plain text
+MAX_RETRIES = 5 # Consecutive failed plug commands after which the plug is left alone for a while
+MAX_BACKOFF = 60 * 30 # Longest time, in seconds, a failing plug is left alone before trying it again
+RETRY_BUDGET = 10 # Max attempts per hour to find the plug again after a failed command
 ERROR_EXIT_VAL = -415 # Error status to exit with, I just like the number :)
 GPU_PROCESS_THRESHOLD = 1 # Threshold for maximum nº of processes running in GPU, above the threshold the device will always be plugged on
 ALWAYS_ON = False # Variable to determine if the plug should always be turned on
 HOLD = False # Hold will halt the process temporarily
+PLUG = None # Persistent session with the plug, built on first use
+PLUG_FACTORY = None # Builds the device of the plug from its devices.json entry, a tinytuya OutletDevice if None
+CLOCK = time.monotonic # Times the backoffs, the plug state cache and METER_INTERVAL
+WALL_CLOCK = time.time # Time of the meter readings
+BREAKER = None # Circuit breaker of the plug, built with PLUG
+PLUG_VERIFY_INTERVAL = 60 * 10 # Seconds the known plug state is trusted before asking the plug again
+SCAN_TIME = 10 # Max seconds spent scanning the network for the plug in a single attempt
+SCAN_CACHE_TTL = 300 # Seconds during which a scan result is reused instead of scanning again
+DISCOVERY = Rediscovery(SCAN_TIME, SCAN_CACHE_TTL)
+REGISTRY = DeviceRegistry(f'{BASEPATH}devices.json') # devices.json in memory, indexed by id, name and ip
+GPU = GpuProbe() # NVML session kept open for the life of the process
+BATTERY = None # Battery backend, sysfs with the files kept open on Linux and psutil elsewhere, created at startup
+LOAD_WINDOW = 5 # Number of samples whose average CPU and memory load is compared against LOAD_THRESHOLD
+LOAD_THRESHOLD = 80 # Average CPU or memory usage, in percent, above which the device is under load and kept plugged
+SAMPLER = None # Reads every sensor concurrently, created at startup
+WAKEUP = Wakeup() # Sleep of the main loop, cut short by parameter changes, plug/unplug events and stop requests
+WATCHER = ConfigWatcher(f'{BASEPATH}parameters.json', changed=WAKEUP) # Keeps the latest valid parameters.json in memory
+POWER_EVENTS = PowerSupplyEvents(WAKEUP) # Wakes the main loop when the charger is plugged or unplugged
+MIN_SLEEP_TIME = 10 # Shortest wait between checks when a threshold is about to be crossed
+MAX_SLEEP_TIME = SLEEP_TIME * 10 # Longest wait between checks when the battery barely changes
+SCHEDULER = SleepScheduler(MIN_SLEEP_TIME, MAX_SLEEP_TIME) # Predicts when the battery will cross a threshold
+HISTORY_PATH = f'{BASEPATH}history.bin' # Ring file where every sample and the action taken are recorded
+RECORDER = None # Appends samples to HISTORY_PATH, created at startup
+METER_INTERVAL = 60 # Seconds between readings of the plug's power meter, 0 to never read it
+METER_PATH = f'{BASEPATH}metering.bin' # Ring file where every meter reading is recorded
+METER = None # Appends readings to METER_PATH, created with the first reading
+LEDGER = EnergyLedger(f'{BASEPATH}energy_ledger.jsonl') # Energy, peak power and efficiency of every charge
+METERING = None # Whether the plug reports its power, None until it was asked
+LAST_METER = 0 # Monotonic time of the last meter reading
+METRICS_PORT = None # Port of the Prometheus metrics endpoint on localhost, disabled if None
+CONTROL = ControlServer(on_change=lambda: WAKEUP.set("control")) # Status queries and HOLD/ALWAYS_ON overrides
+LAST_SAMPLE = None # Latest sample and action, reported by the status command
+LAST_ACTION = None
+NEXT_CHECK = None # Wall clock time of the next check
+BUDGET = RetryBudget(RETRY_BUDGET) # Bounds the rediscoveries of the plug per hour
+HEAP_DIRECTORY = os.path.abspath(BASEPATH or os.curdir) # Where heap snapshots are dumped, next to the log
+ITERATION_DEADLINE = 60 # Seconds a check may take before the steps still running are left behind
+STEPS = Steps(ITERATION_DEADLINE) # Runs every blocking step of a check off the loop, under its own timeout
+LOOP_BACKOFF = Backoff(MIN_SLEEP_TIME, MAX_SLEEP_TIME) # Wait after an unexpected error, longer if it keeps happening
 
 
 def get_parameters():
-    global SLEEP_TIME, INIT_WAIT_TIME, LOW_THRESHOLD, HIGH_THRESHOLD, DEVICE_NAME, FLUSH_PERIOD, MAX_RETRIES, GPU_PROCESS_THRESHOLD, ALWAYS_ON, HOLD
-    with open(f'{BASEPATH}parameters.json') as f:
-        parameters = json.load(f)
+    global SLEEP_TIME, INIT_WAIT_TIME, LOW_THRESHOLD, HIGH_THRESHOLD, DEVICE_NAME, FLUSH_PERIOD, MAX_RETRIES, GPU_PROCESS_THRESHOLD, ALWAYS_ON, HOLD, SCAN_TIME, SCAN_CACHE_TTL, LOAD_WINDOW, LOAD_THRESHOLD, MIN_SLEEP_TIME, MAX_SLEEP_TIME, LOG_MAX_BYTES, LOG_BACKUPS, LOG_JSON, PLUG_VERIFY_INTERVAL, MAX_BACKOFF, RETRY_BUDGET, METER_INTERVAL, ITERATION_DEADLINE
+    # Overrides sent through the control socket win over the file
+    parameters = {**WATCHER.parameters, **CONTROL.overrides}
     SLEEP_TIME = parameters.get('SLEEP_TIME', SLEEP_TIME)
     INIT_WAIT_TIME = parameters.get('INIT_WAIT_TIME', INIT_WAIT_TIME)
     LOW_THRESHOLD = parameters.get('LOW_THRESHOLD', LOW_THRESHOLD)
     HIGH_THRESHOLD = parameters.get('HIGH_THRESHOLD', HIGH_THRESHOLD)
     DEVICE_NAME = parameters['DEVICE_NAME']
     FLUSH_PERIOD = parameters.get("FLUSH_PERIOD", FLUSH_PERIOD)
+    LOG_MAX_BYTES = parameters.get('LOG_MAX_BYTES', LOG_MAX_BYTES)
+    LOG_BACKUPS = parameters.get('LOG_BACKUPS', LOG_BACKUPS)
+    LOG_JSON = parameters.get('LOG_JSON', LOG_JSON)
+    LOGGER.configure(LOG_MAX_BYTES, FLUSH_PERIOD * 60, LOG_BACKUPS, LOG_JSON)
     MAX_RETRIES = parameters.get("MAX_RETRIES", MAX_RETRIES)
+    MAX_BACKOFF = parameters.get('MAX_BACKOFF', MAX_BACKOFF)
+    RETRY_BUDGET = parameters.get('RETRY_BUDGET', RETRY_BUDGET)
+    BUDGET.limit = RETRY_BUDGET
     GPU_PROCESS_THRESHOLD = parameters.get('GPU_PROCESS_THRESHOLD', GPU_PROCESS_THRESHOLD)
-    ALWAYS_ON = parameters.get('ALWAYS_ON', ALWAYS_ON)
-    HOLD = parameters.get('HOLD', HOLD)
-
-
-def get_device(name, devices):
-    for device in devices:
-        if device['name'] == name:
-            return device
-    logging.info(f"Device {name} not found")
-    return None
-
-
-def using_gpu():
-    pynvml.nvmlInit()
-    try:
-        num_gpus = pynvml.nvmlDeviceGetCount()
-        for gpu_id in range(num_gpus):
-            handle = pynvml.nvmlDeviceGetHandleByIndex(gpu_id)
-            num_processes = pynvml.nvmlDeviceGetComputeRunningProcesses(handle)
-            if len(num_processes) > GPU_PROCESS_THRESHOLD:
-                return True
-        return False
-    except pynvml.NVMLError as err:
-        logging.info(err)
-    finally:
-        pynvml.nvmlShutdown()
-
-
-def netscan(retry=0):
-    global HOLD
-    devices = []
-    if retry > MAX_RETRIES:
+    # Off unless set, so that clearing an override goes back to a parameters.json without them
+    ALWAYS_ON = parameters.get('ALWAYS_ON', False)
+    hold = parameters.get('HOLD', False)
+    if hold and not HOLD:
+        metrics.HOLDS.inc()
+    HOLD = hold
+    metrics.HOLD.set(int(HOLD))
+    PLUG_VERIFY_INTERVAL = parameters.get('PLUG_VERIFY_INTERVAL', PLUG_VERIFY_INTERVAL)
+    METER_INTERVAL = parameters.get('METER_INTERVAL', METER_INTERVAL)
+    SCAN_TIME = parameters.get('SCAN_TIME', SCAN_TIME)
+    SCAN_CACHE_TTL = parameters.get('SCAN_CACHE_TTL', SCAN_CACHE_TTL)
+    DISCOVERY.scan_time = SCAN_TIME
+    DISCOVERY.ttl = SCAN_CACHE_TTL
+    LOAD_WINDOW = parameters.get('LOAD_WINDOW', LOAD_WINDOW)
+    LOAD_THRESHOLD = parameters.get('LOAD_THRESHOLD', LOAD_THRESHOLD)
+    if SAMPLER is not None:
+        SAMPLER.window = LOAD_WINDOW
+    MIN_SLEEP_TIME = parameters.get('MIN_SLEEP_TIME', MIN_SLEEP_TIME)
+    MAX_SLEEP_TIME = parameters.get('MAX_SLEEP_TIME', MAX_SLEEP_TIME)
+    SCHEDULER.min_interval = MIN_SLEEP_TIME
+    SCHEDULER.max_interval = MAX_SLEEP_TIME
+    LOOP_BACKOFF.base = MIN_SLEEP_TIME
+    LOOP_BACKOFF.max_delay = MAX_SLEEP_TIME
+    ITERATION_DEADLINE = parameters.get('ITERATION_DEADLINE', ITERATION_DEADLINE)
+    STEPS.deadline = ITERATION_DEADLINE
+
+
+def netscan():
+    devices = DISCOVERY.scan_all()
+    if len(devices) == 0:
         logging.info("Could not scan for devices")
-        HOLD = True
-    try:
-        devices = tinytuya.deviceScan()
-    finally:
-        if len(devices) == 0:
-            devices = netscan(retry + 1)
-        return devices
+    return devices
 
 
 def scan_devices():
-    devices = []
     try:
-        devices = netscan()
-        json.dump([d for d in devices.values()], open(f'{BASEPATH}devices.json', 'w'), default=str, indent=4)
-    except:
-        logging.info("Could not scan for devices")
+        REGISTRY.merge(netscan().values())
+    except Exception as ex:
+        logging.info(f"Could not scan for devices: {ex}")
 
-    finally:
-        return devices
 
+def needs_consuming(sample):
+    logging.info(f"CPU: {sample.cpu}% (average {sample.cpu_average:.1f}%)")
+    logging.info(f"Memory: {sample.memory}% (average {sample.memory_average:.1f}%)")
 
-def needs_consuming():
-    cpu_percent = psutil.cpu_percent(interval=1)
-    memory_percent = psutil.virtual_memory().percent
+    return is_consuming(sample, GPU_PROCESS_THRESHOLD, LOAD_THRESHOLD)
 
-    logging.info(f"CPU: {cpu_percent}%")
-    logging.info(f"Memory: {memory_percent}%")
 
-    too_high_cpu = cpu_percent > 80 or memory_percent > 80
-    return too_high_cpu or using_gpu()
+def get_plug_config():
+    if len(REGISTRY) == 0:
+        logging.info("No devices known, scanning for them")
+        scan_devices()
+    device = REGISTRY.get(DEVICE_NAME)
+    if device is None:
+        logging.info(f"Device {DEVICE_NAME} not found")
+    return device
 
 
-def get_devices(from_scan=False):
-    try:
-        devices = json.load(open(f'{BASEPATH}devices.json'))
-    except FileNotFoundError:
-        logging.info("No devices.json file found")
-        devices = scan_devices()
-    finally:
-        return devices
-
-
-def connect_to_plug():
-    devices = get_devices()
-    if len(devices) == 0:
+def rediscover_plug():
+    device_config = get_plug_config()
+    if device_config is None:
         return None
 
-    device_config = get_device(DEVICE_NAME, devices)
+    address = DISCOVERY.find(device_config['id'], device_config.get('ip'))
+    if address is not None and address != device_config.get('ip'):
+        logging.info(f"Device {DEVICE_NAME} moved to {address}")
+        REGISTRY.update(device_config['id'], ip=address)
+    return address
 
-    if device_config is None:
-        return None
 
-    return tinytuya.OutletDevice(
-        dev_id=device_config['id'],
-        address=device_config['ip'],
-        local_key=device_config['key'],
-        version=3.3
-    )
+def connect_to_plug():
+    global PLUG, BREAKER, METERING
+    if PLUG is not None and PLUG.name != DEVICE_NAME:
+        PLUG.close()
+        PLUG = None
+    if PLUG is None:
+        PLUG = PlugSession(DEVICE_NAME, get_plug_config, verify_interval=PLUG_VERIFY_INTERVAL, factory=PLUG_FACTORY,
+                           clock=CLOCK)
+        METERING = None
+        BREAKER = CircuitBreaker(DEVICE_NAME, MAX_RETRIES, Backoff(max_delay=MAX_BACKOFF), clock=CLOCK)
+    PLUG.verify_interval = PLUG_VERIFY_INTERVAL
+    BREAKER.failure_threshold = MAX_RETRIES
+    BREAKER.backoff.max_delay = MAX_BACKOFF
+    return PLUG
 
 
 def get_battery_level():
-    battery = psutil.sensors_battery()
-    logging.info(f"battery is {battery.percent}")
-    return battery.percent, battery.power_plugged
+    battery = BATTERY.read()
+    if battery.power is None:
+        logging.info(f"battery is {battery.percent}")
+    else:
+        logging.info(f"battery is {battery.percent} ({battery.status}, {battery.power:.1f} W)")
+    return battery
 
-def turn(on):
-    global HOLD
+def turn(on, plugged=None):
+    """Puts the plug in the requested state. True if the plug answered, False if it failed, None if not tried.
 
+    `plugged` is whether the charger was seen by the sample the decision came from, None if there was none.
+    """
+    plug = connect_to_plug()
+    if not BREAKER.allow():
+        logging.info(f"Plug not answering, next attempt in {BREAKER.remaining():.0f}s")
+        return None
     try:
-        plug = connect_to_plug()
-        if plug is None:
-            logging.info("Could not connect to plug")
-
-        if on:
-            try:
-                plug.turn_on()
-                logging.info("Turned on")
-            except:
-                logging.info("Could not turn on plug")
-                if len(scan_devices()) == 0:
-                    logging.info("Something wrong with network or devices")
-                    HOLD = True
-
+        if plug.ensure(on, plugged):
+            logging.info("Turned on" if on else "Turned off")
         else:
-            try:
-                plug.turn_off()
-                logging.info("Turned off")
-            except:
-                logging.info("Could not turn off plug")
-                if len(scan_devices()) == 0:
-                    logging.info("Something wrong with network or devices")
-                    HOLD = True
+            logging.info("Already on" if on else "Already off")
+        BREAKER.success()
+    except PlugError as err:
+        logging.info(f"Could not turn {'on' if on else 'off'} plug: {err}")
+        BREAKER.failure()
+        if BREAKER.state != CLOSED:
+            logging.info(f"Plug circuit {BREAKER.state}, next attempt in {BREAKER.remaining():.0f}s")
+        return False
+    except Exception:
+        # Such as a devices.json entry without a key, it still has to end the trial of a half-open circuit
+        BREAKER.failure()
+        raise
     finally:
-        # if connected_to_wifi_and_ethernet:
-        #     disconnect_from_wifi()
-        pass
+        logging.info(f"Plug session: {plug.stats()}")
+    return True
 
 
-def check_for_flush():
-    check_time = datetime.now()
-    if not LAST_FLUSH or ((check_time - LAST_FLUSH).seconds / 60) > FLUSH_PERIOD:
-        flush()
-        return check_time
-    return LAST_FLUSH
+def retry_allowed():
+    if not BUDGET.spend():
+        logging.info("Retry budget spent, not looking for the plug")
+        return False
+    metrics.RETRIES.inc()
+    return True
+
+
+async def command(on, plugged=None):
+    """Turns the plug on or off, then looks for it on the network if it did not answer."""
+    if await STEPS.optional("plug", turn, on, plugged) is False and retry_allowed():
+        timeout = STEPS.timeouts["discovery"] + SCAN_TIME
+        if await STEPS.optional("discovery", rediscover_plug, timeout=timeout) is None:
+            logging.info("Something wrong with network or devices")
+
+
+def meter_plug(sample=None):
+    """Reads the plug's meter if METER_INTERVAL passed since the last reading, reusing the plug session.
+
+    `sample` is the sample taken in the same check, for the battery level and energy of the charge, or None.
+    """
+    global METERING, LAST_METER, METER
+    if not METER_INTERVAL or METERING is False or CLOCK() - LAST_METER < METER_INTERVAL:
+        return
+    plug = connect_to_plug()
+    if not BREAKER.allow():
+        return
+    LAST_METER = CLOCK()
+    try:
+        reading = read_meter(plug, WALL_CLOCK)
+        BREAKER.success()
+    except PlugError as err:
+        # Including a reply without DPS values, tried again after the meter interval
+        logging.info(f"Could not read the plug meter: {err}")
+        BREAKER.failure()
+        return
+    except Exception:
+        BREAKER.failure()
+        raise
+    if reading is None:
+        logging.info(f"Plug {DEVICE_NAME} does not report its power, not metering it")
+        METERING = False
+        return
+    METERING = True
+    if METER is None:
+        METER = MeterRecorder(METER_PATH)
+    METER.append(reading)
+    LEDGER.add(reading, sample)
+
+
+def status():
+    sample = LAST_SAMPLE
+    return {
+        "device": DEVICE_NAME,
+        "hold": HOLD,
+        "always_on": ALWAYS_ON,
+        "overrides": dict(CONTROL.overrides),
+        "low_threshold": LOW_THRESHOLD,
+        "high_threshold": HIGH_THRESHOLD,
+        "sample": None if sample is None else {
+            "time": sample.time,
+            "battery": sample.battery,
+            "plugged": sample.plugged,
+            "power": sample.power,
+            "cpu_average": sample.cpu_average,
+            "memory_average": sample.memory_average,
+            "gpu_processes": sum(gpu.processes for gpu in sample.gpus),
+        },
+        "action": LAST_ACTION,
+        "next_check": NEXT_CHECK,
+        "plug": None if PLUG is None else {"state": PLUG.state, **PLUG.stats()},
+        "breaker": None if BREAKER is None else BREAKER.status(),
+        "retry_budget": BUDGET.status(),
+        "errors": LOOP_BACKOFF.attempts,
+        "scans": DISCOVERY.scans,
+        "metering": LEDGER.status() if METERING else None,
+        "steps": STEPS.status(),
+    }
+
+
+async def check():
+    """One check of the battery and load, acting on the plug if needed. Returns the seconds until the next one."""
+    global LAST_SAMPLE, LAST_ACTION
+    if HOLD:
+        logging.info("Holding")
+        return SLEEP_TIME
+    if ALWAYS_ON:
+        logging.info("Always on")
+        await command(True)
+        # Only the ledger needs the battery here, a hung read costs it the battery of this reading
+        sample = await STEPS.optional("sensors", SAMPLER.sample, [])
+        if sample is not None:
+            LAST_SAMPLE, LAST_ACTION = sample, True
+        await STEPS.optional("plug", meter_plug, sample)
+        return min(SLEEP_TIME, METER_INTERVAL or SLEEP_TIME)
+    # A hung NVML call only costs the GPU readings of this check, a hung battery read costs the check
+    gpus, sample = await asyncio.gather(STEPS.optional("nvml", GPU.sample, default=[]),
+                                        STEPS.run("sensors", SAMPLER.sample, []))
+    sample = sample._replace(gpus=gpus)
+    battery_level, plugged = sample.battery, sample.plugged
+    SCHEDULER.record(battery_level, plugged, now=CLOCK())
+    consuming = needs_consuming(sample)
+    action = decide(battery_level, plugged, consuming, LOW_THRESHOLD, HIGH_THRESHOLD)
+    if consuming and action:
+        logging.info("Needs consuming")
+    elif action is None:
+        logging.info("Nothing to do")
+    if action is not None:
+        await command(action, plugged)
+    RECORDER.append(sample, action)
+    LAST_SAMPLE, LAST_ACTION = sample, action
+    await STEPS.optional("plug", meter_plug, sample)
+    sleep_time = SCHEDULER.next_interval(LOW_THRESHOLD, HIGH_THRESHOLD, SLEEP_TIME)
+    if METERING and METER_INTERVAL and PLUG.state:
+        # Meter the whole charge closely enough to integrate it
+        sleep_time = min(sleep_time, METER_INTERVAL)
+    return sleep_time
+
+
+async def monitor():
+    global NEXT_CHECK
+    while not WAKEUP.stopped:
+        started = time.monotonic()
+        try:
+            get_parameters()
+            STEPS.begin()
+            sleep_time = await check()
+            LOOP_BACKOFF.reset()
+            logging.info(f"Sleeping {sleep_time:.0f}s")
+        except Exception as ex:
+            sleep_time = MIN_SLEEP_TIME + LOOP_BACKOFF.next()
+            logging.info(f"{ex}, retrying in {sleep_time:.0f}s")
+        # Checks keep to their schedule however long this one took
+        sleep_time = max(0.0, sleep_time - (time.monotonic() - started))
+        NEXT_CHECK = time.time() + sleep_time
+        reasons = await STEPS.wait(WAKEUP, sleep_time)
+        if reasons:
+            logging.info(f"Woken up by {', '.join(sorted(reasons))}")
 
 
 def on_shutdown():
-    if error:
+    if STEPS.busy("plug"):
+        logging.info("Plug still busy with an earlier command, leaving it as it is")
+    elif error:
         turn(True)
     else:
         turn(False)
-
-
-def flush():
-    open(f"{BASEPATH}monitoringLog.log", "w").close()
+    STEPS.close()
+    if PLUG is not None:
+        PLUG.close()
+    # Syncs the last records of the ring files to disk
+    if RECORDER is not None:
+        RECORDER.close()
+    if METER is not None:
+        METER.close()
 
 
 if __name__ == '__main__':
-    time.sleep(INIT_WAIT_TIME)
+    WATCHER.start()
+    CONTROL.command("status", status)
+    CONTROL.command("heap", lambda top=heap_profile.TOP: heap_profile.snapshot(HEAP_DIRECTORY, top))
+    CONTROL.start()
+    heap_profile.install_signal(HEAP_DIRECTORY)
+    METRICS_PORT = WATCHER.parameters.get('METRICS_PORT', METRICS_PORT)
+    if METRICS_PORT:
+        metrics.start_server(METRICS_PORT)
+    # systemd stops the service with SIGTERM, exit through the loop so that on_shutdown runs
+    signal.signal(signal.SIGTERM, lambda signum, frame: WAKEUP.stop())
+    BATTERY = open_battery()
+    # The plug check looks for DEVICE_NAME, it has to come from parameters.json and not the default
+    if WATCHER.parameters:
+        get_parameters()
+    wait_until_ready({
+        "network": network_up,
+        "battery": lambda: BATTERY.read().percent is not None,
+        "plug": lambda: plug_reachable(get_plug_config),
+    }, WAKEUP, INIT_WAIT_TIME)
+    if WAKEUP.stopped:
+        sys.exit(0)
     atexit.register(on_shutdown)
+    SAMPLER = Sampler(get_battery_level, GPU.sample, LOAD_WINDOW)
+    RECORDER = Recorder(HISTORY_PATH)
+    POWER_EVENTS.start()
     logging.info("Started monitoring")
-    while True:
-        try:
-            get_parameters()
-            if HOLD:
-                logging.info("Holding")
-                time.sleep(SLEEP_TIME)
-                continue
-            if ALWAYS_ON:
-                logging.info("Always on")
-                turn(True)
-                time.sleep(SLEEP_TIME)
-                continue
-            LAST_FLUSH = check_for_flush()
-            battery_level, plugged = get_battery_level()
-            if needs_consuming():
-                if not plugged:
-                    logging.info("Needs consuming")
-                    turn(True)
-
-            elif not (LOW_THRESHOLD < battery_level < HIGH_THRESHOLD):
-                turn(battery_level < HIGH_THRESHOLD)
-            else:
-                logging.info("Nothing to do")
-            logging.info("Sleeping")
-            time.sleep(SLEEP_TIME)
-        except Exception as ex:
-            HOLD = True
-            logging.info(ex)
-            time.sleep(SLEEP_TIME)
+    asyncio.run(monitor())
+    logging.info("Stopped monitoring")
+    POWER_EVENTS.stop()
+    CONTROL.stop()
+    WATCHER.stop()
@@ -0,0 +1,234 @@
+"""Searches the thresholds of the charge policy that suit the load recorded in history.bin.
+
+    python optimizer.py --history history.bin
+    python optimizer.py --history history.bin --output parameters.json
+    python optimizer.py --days 30
+
+Every combination of LOW_THRESHOLD, HIGH_THRESHOLD (the gap between both is the hysteresis of the policy),
+LOAD_THRESHOLD and LOAD_WINDOW in the grid is simulated at once: the battery level and plug state of all candidates are
+NumPy arrays, and the load averages of every window are computed up front, so the only Python loop runs over the
+minutes of the trace, whatever the number of candidates. The charge and drain rates of the battery are fitted on the
+recorded history.
+
+Each candidate gets its number of plug toggles, the time spent above 80% charge, the time spent below its own low
+threshold and the lowest level reached. The recommended one is the cheapest in hours above 80% plus a cost per toggle,
+among those whose battery never drops below the safety floor.
+"""
+import argparse
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from simulation import CHARGE_RATE, IDLE_DRAIN, LOAD_DRAIN, STEP, recorded_trace, synthetic_trace
+
+CEILING = 80 # Battery level above which the time spent is counted against a policy, as it wears the battery
+FLOOR = 15 # Candidates whose battery drops below this level are never recommended
+TOGGLE_COST = 0.25 # Hours above the ceiling a plug toggle is worth when ranking candidates
+MAX_GAP = 60 * 10 # Consecutive records further apart than this are not used to fit the battery rates
+MIN_INTERVALS = 30 # Records needed to fit a rate, below that the defaults of simulation.py are used
+FULL = 95 # Charging slows down near full, records above this level are not used to fit the charge rate
+
+LOWS = range(10, 55, 5)
+HIGHS = range(50, 105, 5)
+LOADS = range(50, 105, 5)
+WINDOWS = (1, 3, 5, 10, 15)
+
+Rates = namedtuple("Rates", ["charge", "idle_drain", "load_drain"]) # Percent per second, load_drain at 100% CPU
+Results = namedtuple("Results", ["low", "high", "load", "window", "toggles", "above_ceiling", "below_low",
+                                 "min_level"])
+
+
+def load_history(path):
+    """Records of history.bin as a NumPy structured array, copied so the file can be closed."""
+    from recorder import Recorder
+
+    history = Recorder(path, readonly=True)
+    try:
+        return history.read().copy()
+    finally:
+        history.close()
+
+
+def fit_rates(records, max_gap=MAX_GAP):
+    """Charge rate and idle and load drain of the battery, fitted on consecutive records of the history.
+
+    Levels are whole percents, so the rates are fitted on the sums over many intervals rather than on each of them:
+    the charge rate is the rise over the time spent plugged, and the drain is the least-squares fit of the fall while
+    unplugged against the time and the CPU load.
+    """
+    dt = np.diff(records["time"])
+    rise = np.diff(records["battery"].astype(float))
+    plugged = records["plugged"][:-1].astype(bool) & records["plugged"][1:].astype(bool)
+    unplugged = ~records["plugged"][:-1].astype(bool) & ~records["plugged"][1:].astype(bool)
+    valid = (dt > 0) & (dt <= max_gap)
+
+    charge = CHARGE_RATE
+    charging = valid & plugged & (records["battery"][:-1] < FULL)
+    if charging.sum() >= MIN_INTERVALS and rise[charging].sum() > 0:
+        charge = rise[charging].sum() / dt[charging].sum()
+
+    idle_drain, load_drain = IDLE_DRAIN, LOAD_DRAIN
+    draining = valid & unplugged
+    if draining.sum() >= MIN_INTERVALS:
+        cpu = (records["cpu"][:-1] + records["cpu"][1:])[draining] / 200
+        a = np.column_stack([dt[draining], cpu * dt[draining]])
+        (idle, load), *_ = np.linalg.lstsq(a, -rise[draining], rcond=None)
+        if idle > 0:
+            idle_drain, load_drain = idle, max(0.0, load)
+    return Rates(charge, idle_drain, load_drain)
+
+
+def rolling_average(values, window):
+    """Average of each point and the `window` - 1 before it, as the sampler computes it."""
+    total = np.cumsum(np.concatenate(([0.0], values)))
+    counts = np.minimum(np.arange(1, len(values) + 1), window)
+    ends = np.arange(1, len(values) + 1)
+    return (total[ends] - total[ends - counts]) / counts
+
+
+def candidates(lows=LOWS, highs=HIGHS, loads=LOADS, windows=WINDOWS):
+    """Every combination of the grid with low < high, as four parallel arrays."""
+    low, high, load, window = (axis.ravel() for axis in np.meshgrid(lows, highs, loads, windows, indexing="ij"))
+    keep = low < high
+    return low[keep], high[keep], load[keep], window[keep]
+
+
+def evaluate(trace, rates, low, high, load, window, level=60.0, plugged=False, gpu_process_threshold=1,
+             ceiling=CEILING, consuming_keeps_plug=True):
+    """Runs every candidate policy over the trace, checking once per trace point, and returns their Results."""
+    cpu = np.asarray(trace.cpu, dtype=float)
+    memory = np.asarray(trace.memory, dtype=float)
+    gpu = np.asarray(trace.gpu_processes) > gpu_process_threshold
+    dt = trace.step
+
+    # Whether each (window, load threshold) pair sees the device as consuming, one row per trace point
+    windows, window_index = np.unique(window, return_inverse=True)
+    loads, load_index = np.unique(load, return_inverse=True)
+    consuming_by_kind = np.empty((len(cpu), len(windows) * len(loads)), dtype=bool)
+    for w, size in enumerate(windows):
+        cpu_average = rolling_average(cpu, size)
+        memory_average = rolling_average(memory, size)
+        for t, threshold in enumerate(loads):
+            consuming_by_kind[:, w * len(loads) + t] = (cpu_average > threshold) | (memory_average > threshold) | gpu
+    kind = window_index * len(loads) + load_index
+
+    n = len(low)
+    level = np.full(n, float(level))
+    plugged = np.full(n, bool(plugged))
+    toggles = np.zeros(n, dtype=np.int64)
+    above_ceiling = np.zeros(n)
+    below_low = np.zeros(n)
+    min_level = level.copy()
+    charge_step = rates.charge * dt
+    drain_steps = (rates.idle_drain + rates.load_drain * cpu / 100) * dt
+
+    for i in range(len(cpu)):
+        consuming = consuming_by_kind[i, kind]
+        battery = np.rint(level)
+        force_on = consuming & ~plugged
+        checked = ~consuming if consuming_keeps_plug else ~force_on
+        turn_on = force_on | (checked & (battery <= low))
+        turn_off = checked & (battery >= high)
+        now_plugged = (plugged | turn_on) & ~turn_off
+        toggles += now_plugged != plugged
+        plugged = now_plugged
+        level += np.where(plugged, charge_step, -drain_steps[i])
+        np.clip(level, 0.0, 100.0, out=level)
+        above_ceiling += (level > ceiling) * dt
+        below_low += (level < low) * dt
+        np.minimum(min_level, level, out=min_level)
+    return Results(low, high, load, window, toggles, above_ceiling, below_low, min_level)
+
+
+def ranking(results, floor=FLOOR, toggle_cost=TOGGLE_COST):
+    """Indexes of the candidates that never drop below `floor`, the recommended one first."""
+    safe = np.flatnonzero(results.min_level >= floor)
+    cost = results.above_ceiling[safe] / 3600 + toggle_cost * results.toggles[safe]
+    # Ties go to the fewest toggles, then to the lowest time below the low threshold
+    order = np.lexsort((results.below_low[safe], results.toggles[safe], cost))
+    return safe[order]
+
+
+def recorded_baseline(records, ceiling=CEILING, max_gap=MAX_GAP):
+    """Toggles and hours above the ceiling of the policy that actually ran while the history was recorded."""
+    dt = np.diff(records["time"])
+    valid = (dt > 0) & (dt <= max_gap)
+    toggles = int(np.count_nonzero(np.diff(records["plugged"].astype(np.int8))))
+    above = float(dt[valid & (records["battery"][:-1] > ceiling)].sum())
+    return toggles, above
+
+
+def write_parameters(path, low, high, load, window):
+    """Puts the recommended thresholds in the parameters.json at `path`, keeping its other keys.
+
+    The file is replaced in one rename, so the daemon never reloads it half written.
+    """
+    try:
+        with open(path) as f:
+            parameters = json.load(f)
+    except FileNotFoundError:
+        parameters = {}
+    parameters.update({'LOW_THRESHOLD': int(low), 'HIGH_THRESHOLD': int(high), 'LOAD_THRESHOLD': int(load),
+                       'LOAD_WINDOW': int(window)})
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(parameters, f, indent=4)
+        f.write("\n")
+    os.replace(temporary, path)
+    return parameters
+
+
+def print_results(results, indexes, baseline=None):
+    print(f"{'low':>4} {'high':>4} {'load':>4} {'window':>6} {'toggles':>7} {'above 80%':>10} {'below low':>10} "
+          f"{'min':>5}")
+    if baseline is not None:
+        toggles, above = baseline
+        print(f"{'recorded':>21} {toggles:>7} {above / 3600:>9.1f}h")
+    for i in indexes:
+        print(f"{results.low[i]:>4} {results.high[i]:>4} {results.load[i]:>4} {results.window[i]:>6} "
+              f"{results.toggles[i]:>7} {results.above_ceiling[i] / 3600:>9.1f}h {results.below_low[i] / 3600:>9.1f}h "
+              f"{results.min_level[i]:>4.0f}%")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Search the charge thresholds that suit the recorded load")
+    parser.add_argument("--history", help="history.bin recorded by the daemon")
+    parser.add_argument("--days", type=float, default=30, help="length of the synthetic trace used without --history")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic trace")
+    parser.add_argument("--gpu-process-threshold", type=int, default=1, help="GPU_PROCESS_THRESHOLD")
+    parser.add_argument("--floor", type=float, default=FLOOR, help="lowest battery level a candidate may reach")
+    parser.add_argument("--toggle-cost", type=float, default=TOGGLE_COST, help="hours above 80%% a toggle is worth")
+    parser.add_argument("--top", type=int, default=10, help="candidates listed")
+    parser.add_argument("--windows", action="store_true", help="use the policy of powermonitor_win.py")
+    parser.add_argument("--output", help="parameters.json to write the recommended thresholds to")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.history:
+        records = load_history(args.history)
+        trace = recorded_trace(args.history, STEP)
+        rates = fit_rates(records)
+        start = records[np.searchsorted(records["time"], trace.start)]
+        level, plugged = float(start["battery"]), bool(start["plugged"])
+        baseline = recorded_baseline(records)
+    else:
+        trace = synthetic_trace(args.days, STEP, args.seed)
+        rates = Rates(CHARGE_RATE, IDLE_DRAIN, LOAD_DRAIN)
+        level, plugged = 60.0, False
+    print(f"Battery: charges {rates.charge * 3600:.1f}%/h, drains {rates.idle_drain * 3600:.1f}%/h idle "
+          f"+ {rates.load_drain * 3600:.1f}%/h at full load")
+
+    results = evaluate(trace, rates, *candidates(), level=level, plugged=plugged,
+                       gpu_process_threshold=args.gpu_process_threshold, consuming_keeps_plug=not args.windows)
+    order = ranking(results, args.floor, args.toggle_cost)
+    print(f"{len(results.low)} candidates over {len(trace.cpu) * trace.step / 86400:.1f} days, "
+          f"{len(order)} never below {args.floor:.0f}%")
+    print_results(results, order[:args.top], baseline)
+    if len(order) == 0:
+        raise SystemExit("No candidate keeps the battery above the floor")
+    best = order[0]
+    if args.output:
+        write_parameters(args.output, results.low[best], results.high[best], results.load[best], results.window[best])
+        print(f"Wrote {args.output}")
@@ -0,0 +1,190 @@
+import socket
+import threading
+import time
+
+import metrics
+
+KEEPALIVE_INTERVAL = 20 # Seconds between heartbeats, Tuya plugs drop sockets that stay idle for ~30 seconds
+CONNECTION_TIMEOUT = 5 # Seconds to wait for the plug to accept a connection
+RETRY_LIMIT = 2 # Reconnection attempts tinytuya makes inside a single command
+VERIFY_INTERVAL = 60 * 10 # Seconds a cached relay state is trusted before asking the plug again
+SWITCH = '1' # DPS index of the relay on Tuya plugs
+
+
+class PlugError(Exception):
+    pass
+
+
+class PlugSession:
+    """Keeps one persistent socket open to the plug and reuses it across commands.
+
+    `resolve` is called with no arguments whenever the underlying device has to be built, and must return the
+    device entry from devices.json (a dict with 'id', 'ip' and 'key') or None if the plug is unknown. `factory`
+    builds the device from that entry and `clock` times the state cache; both are only replaced in simulations.
+    With `keepalive_thread=False` no thread is started and the owner must call heartbeat() every
+    `keepalive_interval` seconds, so that many sessions can share one.
+    """
+
+    def __init__(self, name, resolve, version=3.3, keepalive_interval=KEEPALIVE_INTERVAL,
+                 verify_interval=VERIFY_INTERVAL, factory=None, clock=time.monotonic, keepalive_thread=True):
+        self.name = name
+        self.resolve = resolve
+        self.factory = factory or self._outlet
+        self.clock = clock
+        self.version = version
+        self.keepalive_interval = keepalive_interval
+        self.verify_interval = verify_interval
+        self.keepalive_thread = keepalive_thread
+        self.connects = 0 # First socket opened by the session
+        self.reuses = 0 # Commands served on an already open socket
+        self.reconnects = 0 # Sockets opened after an earlier one was closed, dropped or reset
+        self.suppressed = 0 # Commands not sent because the plug was already in the requested state
+        self.state = None # Last relay state confirmed by the plug, None if unknown
+        self._verified_at = 0
+        self._device = None
+        self._last_used = 0
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._keepalive_thread = None
+
+    def _get_device(self):
+        if self._device is None:
+            config = self.resolve()
+            if config is None:
+                raise PlugError(f"Device {self.name} not found")
+            self._device = self.factory(config)
+            self._start_keepalive()
+        return self._device
+
+    def _outlet(self, config):
+        # Imported on first use, it takes longer to load than the rest of the daemon
+        import tinytuya
+
+        device = tinytuya.OutletDevice(
+            dev_id=config['id'],
+            address=config['ip'],
+            local_key=config['key'],
+            version=self.version,
+            port=config.get('port', 6668),
+            persist=True,
+            connection_timeout=CONNECTION_TIMEOUT,
+            connection_retry_limit=RETRY_LIMIT,
+            connection_retry_delay=1
+        )
+        # tinytuya sleeps 10 ms after every send by default, the reply is awaited anyway
+        device.set_sendWait(None)
+        return device
+
+    def _account(self, before, after):
+        if after is None:
+            return
+        if after is before:
+            self.reuses += 1
+            return
+        # A socket closed by heartbeat() or dropped by reset() leaves no previous one, it is still a reconnect
+        if self.connects == 0:
+            self.connects += 1
+        else:
+            self.reconnects += 1
+        after.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            after.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive_interval)
+
+    def _send(self, request):
+        with self._lock:
+            device = self._get_device()
+            before = device.socket
+            start = time.perf_counter()
+            data = request(device)
+            elapsed = time.perf_counter() - start
+            self._account(before, device.socket)
+            if device.socket is not None and device.socket is before:
+                metrics.PLUG_COMMAND.observe(elapsed)
+            else:
+                metrics.PLUG_CONNECT.observe(elapsed)
+            self._last_used = time.monotonic()
+            if isinstance(data, dict) and 'Error' in data:
+                # Drop the device so the next command resolves the address again
+                self.reset()
+                raise PlugError(data['Error'])
+            return data
+
+    def _confirm(self, data):
+        dps = data.get('dps', {}) if isinstance(data, dict) else {}
+        self.state = dps.get(SWITCH)
+        self._verified_at = self.clock()
+        metrics.PLUG_STATE.set(-1 if self.state is None else int(self.state))
+        return self.state
+
+    def turn(self, on):
+        previous = self.state
+        # Plugs answer a command with the new DPS values. An empty reply does not tell whether it was applied, the
+        # state is left unknown so that the next ensure() sends the command again.
+        data = self._send(lambda device: device.set_status(on, SWITCH))
+        state = self._confirm(data)
+        if state is not None and state != previous:
+            metrics.TOGGLES.inc()
+        return data
+
+    def status(self):
+        data = self._send(lambda device: device.status())
+        self._confirm(data)
+        return data
+
+    def ensure(self, on, plugged=None):
+        """Puts the relay in the requested state, only talking to the plug if it is not known to be there already.
+
+        `plugged` is whether the machine sees its charger, when known. If it contradicts the cached relay state the
+        plug is asked again at once, instead of after `verify_interval`. Returns True if a command was sent.
+        """
+        if self.state == on and (self.clock() - self._verified_at >= self.verify_interval
+                                 or plugged is not None and plugged != self.state):
+            # Someone may have toggled the plug by hand, or it power-cycled, since we last heard from it
+            self.status()
+        if self.state == on:
+            self.suppressed += 1
+            return False
+        self.turn(on)
+        return True
+
+    def heartbeat(self):
+        with self._lock:
+            device = self._device
+            if device is None or device.socket is None:
+                return
+            if time.monotonic() - self._last_used < self.keepalive_interval:
+                return
+            try:
+                device.heartbeat(nowait=True)
+                self._last_used = time.monotonic()
+            except Exception:
+                # Next command will open a new socket
+                device.close()
+
+    def _keepalive_loop(self):
+        while not self._stop.wait(self.keepalive_interval):
+            self.heartbeat()
+
+    def _start_keepalive(self):
+        if not self.keepalive_thread:
+            return
+        if self._keepalive_thread is None or not self._keepalive_thread.is_alive():
+            self._stop.clear()
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+            self._keepalive_thread.start()
+
+    def reset(self):
+        with self._lock:
+            self.state = None
+            metrics.PLUG_STATE.set(-1)
+            if self._device is not None:
+                self._device.close()
+                self._device = None
+
+    def close(self):
+        self._stop.set()
+        self.reset()
+
+    def stats(self):
+        return {"connects": self.connects, "reuses": self.reuses, "reconnects": self.reconnects,
+                "suppressed": self.suppressed}
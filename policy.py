@@ -0,0 +1,21 @@
+LOAD_THRESHOLD = 80 # Average CPU or memory usage, in percent, above which the device is considered to be under load
+
+
+def is_consuming(sample, gpu_process_threshold, load_threshold=LOAD_THRESHOLD):
+    too_high = sample.cpu_average > load_threshold or sample.memory_average > load_threshold
+    return too_high or any(gpu.processes > gpu_process_threshold for gpu in sample.gpus)
+
+
+def decide(battery_level, plugged, consuming, low_threshold, high_threshold, consuming_keeps_plug=True):
+    """Returns True to turn the plug on, False to turn it off, or None to leave it alone.
+
+    With `consuming_keeps_plug` (monitorer.py), a device under load that is already plugged is left alone. Without
+    it (powermonitor_win.py), such a device still goes through the threshold check.
+    """
+    if consuming and not plugged:
+        return True
+    if consuming and consuming_keeps_plug:
+        return None
+    if not (low_threshold < battery_level < high_threshold):
+        return battery_level < high_threshold
+    return None
@@ -1,23 +1,39 @@
+import asyncio
 import atexit
 import logging
 import os
 import subprocess
 import sys
+import threading
 import time
-from datetime import datetime
 
 import psutil
 import servicemanager
-import tinytuya
 import win32event
 import win32service
 import win32serviceutil
 import json
-import pynvml
-import re
-from pathlib import Path
 
-import requests
+from plug_session import PlugSession, PlugError
+from discovery import Rediscovery
+from device_registry import DeviceRegistry
+from gpu_probe import GpuProbe
+from sampler import Sampler
+from config_watcher import ConfigWatcher
+from scheduler import SleepScheduler
+from recorder import Recorder
+from log_pipeline import setup_logging
+from policy import decide, LOAD_THRESHOLD
+from wakeup import Wakeup
+from control import ControlServer
+import heap_profile
+from readiness import network_up, plug_reachable, wait_until_ready
+from resilience import CLOSED, Backoff, CircuitBreaker, RetryBudget
+from metering import EnergyLedger, MeterRecorder, read_meter
+from steps import Steps
+import metrics
+
+PBT_APMPOWERSTATUSCHANGE = 0x000A # Power event sent when the AC adapter is plugged or unplugged
 
 
 class PowerMonitorService(win32serviceutil.ServiceFramework):
@@ -33,150 +49,187 @@ class PowerMonitorService(win32serviceutil.ServiceFramework):
         self.high_threshold = 80
         self.device_name = "esmarto"
         self.base_path = r'/proyectos/Python/powermonitor/' if os.name == "nt" else ""
-        logging.basicConfig(filename=f'{self.base_path}monitoringLog.log', encoding='utf-8',
-                            format='%(asctime)s %(message)s',
-                            level=logging.DEBUG)
+        self.logger = setup_logging(f'{self.base_path}monitoringLog.log')
         self.sleep_time = 60 * 1
         self.init_wait_time = self.sleep_time * 2
-        self.last_flush = None
         self.flush_period = 60
+        self.log_max_bytes = 1024 * 1024
+        self.log_backups = 5
+        self.log_json = False
         self.max_retries = 5
+        self.max_backoff = 60 * 30
+        self.retry_budget = 10
+        self.budget = RetryBudget(self.retry_budget)
+        self.breaker = None
         self.error_exit_val = -415
         self.gpu_process_threshold = 1
         self.always_on = False
         self.hold = False
+        self.plug = None
+        self.plug_verify_interval = 60 * 10
+        self.scan_time = 10
+        self.scan_cache_ttl = 300
+        self.discovery = Rediscovery(self.scan_time, self.scan_cache_ttl)
+        self.registry = DeviceRegistry(f'{self.base_path}devices.json')
+        self.gpu = GpuProbe()
+        self.load_window = 5
+        self.load_threshold = LOAD_THRESHOLD
+        self.sampler = Sampler(self.get_battery_level, self.gpu.sample, self.load_window)
+        self.wakeup = Wakeup()
+        self.watcher = ConfigWatcher(f'{self.base_path}parameters.json', changed=self.wakeup)
+        self.min_sleep_time = 10
+        self.max_sleep_time = self.sleep_time * 10
+        self.scheduler = SleepScheduler(self.min_sleep_time, self.max_sleep_time)
+        self.loop_backoff = Backoff(self.min_sleep_time, self.max_sleep_time)
+        self.iteration_deadline = 60
+        self.steps = Steps(self.iteration_deadline)
+        self.recorder = None
+        self.meter_interval = 60
+        self.meter = None
+        self.ledger = EnergyLedger(f'{self.base_path}energy_ledger.jsonl')
+        self.metering = None
+        self.last_meter = 0
+        self.metrics_port = None
+        self.control = ControlServer(on_change=lambda: self.wakeup.set("control"))
+        self.control.command("status", self.status)
+        self.control.command("heap", lambda top=heap_profile.TOP: heap_profile.snapshot(
+            os.path.abspath(self.base_path or os.curdir), top))
+        self.last_sample = None
+        self.last_action = None
+        self.next_check = None
 
     def GetAcceptedControls(self):
         result = win32serviceutil.ServiceFramework.GetAcceptedControls(self)
-        result |= win32service.SERVICE_ACCEPT_PRESHUTDOWN
+        result |= win32service.SERVICE_ACCEPT_PRESHUTDOWN | win32service.SERVICE_ACCEPT_POWEREVENT
         return result
 
-    def get_device(self, name, devices):
-        for device in devices:
-            if device['name'] == name:
-                return device
-        logging.info(f"Device {name} not found")
-        return None
+    def SvcOtherEx(self, control, event_type, data):
+        if control == win32service.SERVICE_CONTROL_POWEREVENT and event_type == PBT_APMPOWERSTATUSCHANGE:
+            logging.info("Power status changed")
+            self.wakeup.set("power_supply")
 
-    def netscan(self, retry=0):
-        devices = []
-        if retry > self.max_retries:
-            logging.info("Could not scan for devices")
-            self.hold = True
-        try:
-            devices = tinytuya.deviceScan()
-        finally:
-            if len(devices) == 0:
-                devices = self.netscan(retry + 1)
-            return devices
+    def wait_for_stop(self):
+        """Turns the stop event signaled by SvcStop into a wakeup of the main loop."""
+        win32event.WaitForSingleObject(self.event, win32event.INFINITE)
+        self.wakeup.stop()
 
-    def scan_devices(self):
-        devices = []
-        try:
-            devices = self.netscan()
-            json.dump([d for d in devices.values()], open(f'{self.base_path}devices.json', 'w'), default=str, indent=4)
-        except:
+    def netscan(self):
+        devices = self.discovery.scan_all()
+        if len(devices) == 0:
             logging.info("Could not scan for devices")
+        return devices
 
-        finally:
-            return devices
-
-    def get_devices(self, from_scan=False):
+    def scan_devices(self):
         try:
-            devices = json.load(open(f'{self.base_path}devices.json'))
-        except FileNotFoundError:
-            logging.info("No devices.json file found")
-            devices = self.scan_devices()
-        finally:
-            return devices
-
-    def connect_to_plug(self):
-        devices = self.get_devices()
-        if len(devices) == 0:
-            return None
-
-        device_config = self.get_device(self.device_name, devices)
-
+            self.registry.merge(self.netscan().values())
+        except Exception as ex:
+            logging.info(f"Could not scan for devices: {ex}")
+
+    def get_plug_config(self):
+        if len(self.registry) == 0:
+            logging.info("No devices known, scanning for them")
+            self.scan_devices()
+        device = self.registry.get(self.device_name)
+        if device is None:
+            logging.info(f"Device {self.device_name} not found")
+        return device
+
+    def rediscover_plug(self):
+        device_config = self.get_plug_config()
         if device_config is None:
             return None
 
-        return tinytuya.OutletDevice(
-            dev_id=device_config['id'],
-            address=device_config['ip'],
-            local_key=device_config['key'],
-            version=3.3
-        )
+        address = self.discovery.find(device_config['id'], device_config.get('ip'))
+        if address is not None and address != device_config.get('ip'):
+            logging.info(f"Device {self.device_name} moved to {address}")
+            self.registry.update(device_config['id'], ip=address)
+        return address
+
+    def connect_to_plug(self):
+        if self.plug is not None and self.plug.name != self.device_name:
+            self.plug.close()
+            self.plug = None
+        if self.plug is None:
+            self.plug = PlugSession(self.device_name, self.get_plug_config, verify_interval=self.plug_verify_interval)
+            self.metering = None
+            self.breaker = CircuitBreaker(self.device_name, self.max_retries, Backoff(max_delay=self.max_backoff))
+        self.plug.verify_interval = self.plug_verify_interval
+        self.breaker.failure_threshold = self.max_retries
+        self.breaker.backoff.max_delay = self.max_backoff
+        return self.plug
 
     def get_battery_level(self):
         battery = psutil.sensors_battery()
         logging.info(f"Battery: {battery.percent}%")
         return battery.percent, battery.power_plugged
 
-    def turn(self, on):
+    def turn(self, on, plugged=None):
+        """Puts the plug in the requested state. True if the plug answered, False if it failed, None if not tried.
+
+        `plugged` is whether the charger was seen by the sample the decision came from, None if there was none.
+        """
         # connected_to_wifi_and_ethernet = False
         # if self.is_ethernet_connected():
         #     try:
         #         connected_to_wifi_and_ethernet = self.connect_to_wifi()
         #     except Exception as ex:
         #         logging.info("Could not connect to wifi: " + str(ex))
+        plug = self.connect_to_plug()
+        if not self.breaker.allow():
+            logging.info(f"Plug not answering, next attempt in {self.breaker.remaining():.0f}s")
+            return None
         try:
-            plug = self.connect_to_plug()
-            if plug is None:
-                logging.info("Could not connect to plug")
-
-            if on:
-                try:
-                    plug.turn_on()
-                    logging.info("Turned on")
-                except:
-                    logging.info("Could not turn on plug")
-                    if len(self.scan_devices()) == 0:
-                        logging.info("Something wrong with network or devices")
-                        self.hold = True
-
+            if plug.ensure(on, plugged):
+                logging.info("Turned on" if on else "Turned off")
             else:
-                try:
-                    plug.turn_off()
-                    logging.info("Turned off")
-                except:
-                    logging.info("Could not turn off plug")
-                    if len(self.scan_devices()) == 0:
-                        logging.info("Something wrong with network or devices")
-                        self.hold = True
+                logging.info("Already on" if on else "Already off")
+            self.breaker.success()
+        except PlugError as err:
+            logging.info(f"Could not turn {'on' if on else 'off'} plug: {err}")
+            self.breaker.failure()
+            if self.breaker.state != CLOSED:
+                logging.info(f"Plug circuit {self.breaker.state}, next attempt in {self.breaker.remaining():.0f}s")
+            return False
+        except Exception:
+            # Such as a devices.json entry without a key, it still has to end the trial of a half-open circuit
+            self.breaker.failure()
+            raise
         finally:
             # if connected_to_wifi_and_ethernet:
             #     self.disconnect_from_wifi()
-            pass
-
+            logging.info(f"Plug session: {plug.stats()}")
+        return True
 
-    def using_gpu(self):
-        pynvml.nvmlInit()
-        try:
-            num_gpus = pynvml.nvmlDeviceGetCount()
-            for gpu_id in range(num_gpus):
-                handle = pynvml.nvmlDeviceGetHandleByIndex(gpu_id)
-                num_processes = pynvml.nvmlDeviceGetComputeRunningProcesses(handle)
-                if len(num_processes) > self.gpu_process_threshold:
-                    logging.info(f"GPU {gpu_id} is being used")
-                    logging.info(f"Processes: {num_processes} for threshold: {self.gpu_process_threshold}")
-                    return True
+    def retry_allowed(self):
+        if not self.budget.spend():
+            logging.info("Retry budget spent, not looking for the plug")
             return False
-        except pynvml.NVMLError as err:
-            logging.info(err)
-        finally:
-            pynvml.nvmlShutdown()
-
-    def needs_consuming(self):
-        cpu_percent = psutil.cpu_percent(interval=1)
-        memory_percent = psutil.virtual_memory().percent
+        metrics.RETRIES.inc()
+        return True
+
+    async def command(self, on, plugged=None):
+        """Turns the plug on or off, then looks for it on the network if it did not answer."""
+        if await self.steps.optional("plug", self.turn, on, plugged) is False and self.retry_allowed():
+            timeout = self.steps.timeouts["discovery"] + self.scan_time
+            if await self.steps.optional("discovery", self.rediscover_plug, timeout=timeout) is None:
+                logging.info("Something wrong with network or devices")
+
+    def using_gpu(self, gpus):
+        for gpu in gpus:
+            if gpu.processes > self.gpu_process_threshold:
+                logging.info(f"GPU {gpu.index} is being used")
+                logging.info(f"Processes: {gpu.processes} for threshold: {self.gpu_process_threshold}")
+                return True
+        return False
 
-        logging.info(f"CPU: {cpu_percent}%")
-        logging.info(f"Memory: {memory_percent}%")
+    def needs_consuming(self, sample):
+        logging.info(f"CPU: {sample.cpu}% (average {sample.cpu_average:.1f}%)")
+        logging.info(f"Memory: {sample.memory}% (average {sample.memory_average:.1f}%)")
 
-        too_high = cpu_percent > 80 or memory_percent > 80
+        too_high = sample.cpu_average > self.load_threshold or sample.memory_average > self.load_threshold
         if too_high:
             logging.info("Too high cpu or memory usage")
-        return too_high or self.using_gpu()
+        return too_high or self.using_gpu(sample.gpus)
 
     def is_ethernet_connected(self):
         try:
@@ -197,7 +250,8 @@ class PowerMonitorService(win32serviceutil.ServiceFramework):
     def connect_to_wifi(self):
         """Connects to a specified Wi-Fi network using subprocess."""
         result = False
-        wifi_config = json.load(open(f'{self.base_path}wifi_config.json'))
+        with open(f'{self.base_path}wifi_config.json') as f:
+            wifi_config = json.load(f)
         ssid = wifi_config['ssid']
         password = wifi_config['password']
 
@@ -223,80 +277,213 @@ class PowerMonitorService(win32serviceutil.ServiceFramework):
 
         return result
 
-    def check_for_flush(self):
-        check_time = datetime.now()
-        if not self.last_flush or ((check_time - self.last_flush).seconds / 60) > self.flush_period:
-            self.flush()
-            return check_time
-        return self.last_flush
+    def meter_plug(self, sample=None):
+        """Reads the plug's meter if meter_interval passed since the last reading, reusing the plug session.
+
+        `sample` is the sample taken in the same check, for the battery level and energy of the charge, or None.
+        """
+        if not self.meter_interval or self.metering is False:
+            return
+        if time.monotonic() - self.last_meter < self.meter_interval:
+            return
+        plug = self.connect_to_plug()
+        if not self.breaker.allow():
+            return
+        self.last_meter = time.monotonic()
+        try:
+            reading = read_meter(plug)
+            self.breaker.success()
+        except PlugError as err:
+            # Including a reply without DPS values, tried again after the meter interval
+            logging.info(f"Could not read the plug meter: {err}")
+            self.breaker.failure()
+            return
+        except Exception:
+            self.breaker.failure()
+            raise
+        if reading is None:
+            logging.info(f"Plug {self.device_name} does not report its power, not metering it")
+            self.metering = False
+            return
+        self.metering = True
+        if self.meter is None:
+            self.meter = MeterRecorder(f'{self.base_path}metering.bin')
+        self.meter.append(reading)
+        self.ledger.add(reading, sample)
+
+    def status(self):
+        sample = self.last_sample
+        return {
+            "device": self.device_name,
+            "hold": self.hold,
+            "always_on": self.always_on,
+            "overrides": dict(self.control.overrides),
+            "low_threshold": self.low_threshold,
+            "high_threshold": self.high_threshold,
+            "sample": None if sample is None else {
+                "time": sample.time,
+                "battery": sample.battery,
+                "plugged": sample.plugged,
+                "power": sample.power,
+                "cpu_average": sample.cpu_average,
+                "memory_average": sample.memory_average,
+                "gpu_processes": sum(gpu.processes for gpu in sample.gpus),
+            },
+            "action": self.last_action,
+            "next_check": self.next_check,
+            "plug": None if self.plug is None else {"state": self.plug.state, **self.plug.stats()},
+            "breaker": None if self.breaker is None else self.breaker.status(),
+            "retry_budget": self.budget.status(),
+            "errors": self.loop_backoff.attempts,
+            "scans": self.discovery.scans,
+            "metering": self.ledger.status() if self.metering else None,
+            "steps": self.steps.status(),
+        }
 
     def on_shutdown(self):
         exit_code = 0
         if exit_code == self.error_exit_val:
             # do not trigger on error exit
             return
+        elif self.steps.busy("plug"):
+            logging.info("Plug still busy with an earlier command, leaving it as it is")
         else:
             self.turn(False)
-
-    def flush(self):
-        open(f"{self.base_path}monitoringLog.log", "w").close()
+        self.steps.close()
+        if self.plug is not None:
+            self.plug.close()
+        # Syncs the last records of the ring files to disk
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.meter is not None:
+            self.meter.close()
 
     def get_parameters(self):
-        with open(f'{self.base_path}parameters.json') as f:
-            parameters = json.load(f)
+        # Changed keys are logged by the watcher when the file is reloaded, overrides from the control pipe win over it
+        parameters = {**self.watcher.parameters, **self.control.overrides}
         self.sleep_time = parameters.get('SLEEP_TIME', self.sleep_time)
-        logging.info(f"Sleep time: {self.sleep_time}")
         self.init_wait_time = parameters.get('INIT_WAIT_TIME', self.init_wait_time)
-        logging.info(f"Init wait time: {self.init_wait_time}")
         self.low_threshold = parameters.get('LOW_THRESHOLD', self.low_threshold)
-        logging.info(f"Low threshold: {self.low_threshold}")
         self.high_threshold = parameters.get('HIGH_THRESHOLD', self.high_threshold)
-        logging.info(f"High threshold: {self.high_threshold}")
         self.device_name = parameters.get('DEVICE_NAME', self.device_name)
-        logging.info(f"Device name: {self.device_name}")
         self.flush_period = parameters.get('FLUSH_PERIOD', self.flush_period)
-        logging.info(f"Flush period: {self.flush_period}")
+        self.log_max_bytes = parameters.get('LOG_MAX_BYTES', self.log_max_bytes)
+        self.log_backups = parameters.get('LOG_BACKUPS', self.log_backups)
+        self.log_json = parameters.get('LOG_JSON', self.log_json)
+        self.logger.configure(self.log_max_bytes, self.flush_period * 60, self.log_backups, self.log_json)
         self.max_retries = parameters.get('MAX_RETRIES', self.max_retries)
-        logging.info(f"Max retries: {self.max_retries}")
+        self.max_backoff = parameters.get('MAX_BACKOFF', self.max_backoff)
+        self.retry_budget = parameters.get('RETRY_BUDGET', self.retry_budget)
+        self.budget.limit = self.retry_budget
         self.gpu_process_threshold = parameters.get('GPU_PROCESS_THRESHOLD', self.gpu_process_threshold)
-        logging.info(f"GPU process threshold: {self.gpu_process_threshold}")
-        self.always_on = parameters.get('ALWAYS_ON', self.always_on)
-        logging.info(f"Always on: {self.always_on}")
-        self.hold = parameters.get('HOLD', self.hold)
-        logging.info(f"Hold: {self.hold}")
+        # Off unless set, so that clearing an override goes back to a parameters.json without them
+        self.always_on = parameters.get('ALWAYS_ON', False)
+        hold = parameters.get('HOLD', False)
+        if hold and not self.hold:
+            metrics.HOLDS.inc()
+        self.hold = hold
+        metrics.HOLD.set(int(self.hold))
+        self.plug_verify_interval = parameters.get('PLUG_VERIFY_INTERVAL', self.plug_verify_interval)
+        self.meter_interval = parameters.get('METER_INTERVAL', self.meter_interval)
+        self.scan_time = parameters.get('SCAN_TIME', self.scan_time)
+        self.scan_cache_ttl = parameters.get('SCAN_CACHE_TTL', self.scan_cache_ttl)
+        self.discovery.scan_time = self.scan_time
+        self.discovery.ttl = self.scan_cache_ttl
+        self.load_window = parameters.get('LOAD_WINDOW', self.load_window)
+        self.sampler.window = self.load_window
+        self.load_threshold = parameters.get('LOAD_THRESHOLD', self.load_threshold)
+        self.min_sleep_time = parameters.get('MIN_SLEEP_TIME', self.min_sleep_time)
+        self.max_sleep_time = parameters.get('MAX_SLEEP_TIME', self.max_sleep_time)
+        self.scheduler.min_interval = self.min_sleep_time
+        self.scheduler.max_interval = self.max_sleep_time
+        self.loop_backoff.base = self.min_sleep_time
+        self.loop_backoff.max_delay = self.max_sleep_time
+        self.iteration_deadline = parameters.get('ITERATION_DEADLINE', self.iteration_deadline)
+        self.steps.deadline = self.iteration_deadline
 
     def main(self):
-        time.sleep(self.init_wait_time)
+        self.watcher.start()
+        self.control.start()
+        self.metrics_port = self.watcher.parameters.get('METRICS_PORT', self.metrics_port)
+        if self.metrics_port:
+            metrics.start_server(self.metrics_port)
+        threading.Thread(target=self.wait_for_stop, name="service-stop", daemon=True).start()
+        # The plug check looks for the device name, it has to come from parameters.json and not the default
+        self.get_parameters()
+        wait_until_ready({
+            "network": network_up,
+            "battery": lambda: self.get_battery_level()[0] is not None,
+            "plug": lambda: plug_reachable(self.get_plug_config),
+        }, self.wakeup, self.init_wait_time)
+        if self.wakeup.stopped:
+            return
         atexit.register(self.on_shutdown)
+        self.recorder = Recorder(f'{self.base_path}history.bin')
         logging.info("Started monitoring")
 
-        while True:
+        asyncio.run(self.monitor())
+        logging.info("Stopped monitoring")
+        self.control.stop()
+        self.watcher.stop()
+        atexit.unregister(self.on_shutdown)
+        self.on_shutdown()
+
+    async def check(self):
+        """One check of the battery and load, acting on the plug if needed. Returns the seconds until the next one."""
+        if self.hold:
+            logging.info("Holding")
+            return self.sleep_time
+        if self.always_on:
+            logging.info("Always on")
+            await self.command(True)
+            # Only the ledger needs the battery here, a hung read costs it the battery of this reading
+            sample = await self.steps.optional("sensors", self.sampler.sample, [])
+            if sample is not None:
+                self.last_sample, self.last_action = sample, True
+            await self.steps.optional("plug", self.meter_plug, sample)
+            return min(self.sleep_time, self.meter_interval or self.sleep_time)
+        # A hung NVML call only costs the GPU readings of this check, a hung battery read costs the check
+        gpus, sample = await asyncio.gather(self.steps.optional("nvml", self.gpu.sample, default=[]),
+                                            self.steps.run("sensors", self.sampler.sample, []))
+        sample = sample._replace(gpus=gpus)
+        battery_level, plugged = sample.battery, sample.plugged
+        self.scheduler.record(battery_level, plugged)
+        consuming = self.needs_consuming(sample)
+        action = decide(battery_level, plugged, consuming, self.low_threshold, self.high_threshold,
+                        consuming_keeps_plug=False)
+        if consuming and not plugged:
+            logging.info("Needs consuming")
+        elif action is None:
+            logging.info("Nothing to do")
+        if action is not None:
+            await self.command(action, plugged)
+        self.recorder.append(sample, action)
+        self.last_sample, self.last_action = sample, action
+        await self.steps.optional("plug", self.meter_plug, sample)
+        sleep_time = self.scheduler.next_interval(self.low_threshold, self.high_threshold, self.sleep_time)
+        if self.metering and self.meter_interval and self.plug.state:
+            # Meter the whole charge closely enough to integrate it
+            sleep_time = min(sleep_time, self.meter_interval)
+        return sleep_time
+
+    async def monitor(self):
+        while not self.wakeup.stopped:
+            started = time.monotonic()
             try:
                 self.get_parameters()
-                if self.hold:
-                    logging.info("Holding")
-                    time.sleep(self.sleep_time)
-                    continue
-                if self.always_on:
-                    logging.info("Always on")
-                    self.turn(True)
-                    time.sleep(self.sleep_time)
-                    continue
-                self.last_flush = self.check_for_flush()
-                battery_level, plugged = self.get_battery_level()
-                if self.needs_consuming() and not plugged:
-                    logging.info("Needs consuming")
-                    self.turn(True)
-                else:
-                    if not (self.low_threshold < battery_level < self.high_threshold):
-                        self.turn(battery_level < self.high_threshold)
-                    else:
-                        logging.info("Nothing to do")
-                logging.info("Sleeping")
-                time.sleep(self.sleep_time)
+                self.steps.begin()
+                sleep_time = await self.check()
+                self.loop_backoff.reset()
+                logging.info(f"Sleeping {sleep_time:.0f}s")
             except Exception as ex:
-                self.hold = True
-                logging.info(ex)
+                sleep_time = self.min_sleep_time + self.loop_backoff.next()
+                logging.info(f"{ex}, retrying in {sleep_time:.0f}s")
+            # Checks keep to their schedule however long this one took
+            sleep_time = max(0.0, sleep_time - (time.monotonic() - started))
+            self.next_check = time.time() + sleep_time
+            reasons = await self.steps.wait(self.wakeup, sleep_time)
+            if reasons:
+                logging.info(f"Woken up by {', '.join(sorted(reasons))}")
 
     def switch_to_ethernet(self):
         """Disconnects from Wi-Fi and connects to Ethernet."""
@@ -337,7 +524,7 @@ class PowerMonitorService(win32serviceutil.ServiceFramework):
         self.main()
 
     def SvcStop(self):
-        self.on_shutdown()
+        # main() turns the plug off on its way out
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
         win32event.SetEvent(self.event)
 
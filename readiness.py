@@ -0,0 +1,58 @@
+"""Readiness of the machine after boot, checked before the first decision instead of waiting a fixed time."""
+import logging
+import socket
+import time
+
+import psutil
+
+from discovery import probe
+
+POLL_INTERVAL = 2 # Seconds between two rounds of the checks that did not pass yet
+
+
+def network_up():
+    """True if an interface other than loopback is up and has an IPv4 address."""
+    addresses = psutil.net_if_addrs()
+    for name, stats in psutil.net_if_stats().items():
+        if stats.isup and any(address.family == socket.AF_INET and not address.address.startswith("127.")
+                              for address in addresses.get(name, [])):
+            return True
+    return False
+
+
+def plug_reachable(config):
+    """True if the plug described by `config`, a callable returning its devices.json entry, accepts connections."""
+    device = config()
+    return device is not None and bool(device.get('ip')) and probe(device['ip'])
+
+
+def wait_until_ready(checks, wakeup, timeout, poll_interval=POLL_INTERVAL, clock=time.monotonic):
+    """Runs the `checks`, a dict of name: callable returning True once ready, until all of them passed.
+
+    A check that passed is not run again. Gives up after `timeout` seconds, or as soon as `wakeup` is stopped, and
+    returns the names of the checks that never passed.
+    """
+    start = clock()
+    deadline = start + timeout
+    pending = dict(checks)
+    failed = set() # Checks whose error was logged, once is enough
+    while True:
+        for name, check in list(pending.items()):
+            try:
+                ready = check()
+            except Exception as ex:
+                if name not in failed:
+                    logging.info(f"Readiness check {name} failed: {ex}")
+                    failed.add(name)
+                ready = False
+            if ready:
+                del pending[name]
+        remaining = deadline - clock()
+        if not pending or remaining <= 0 or wakeup.stopped:
+            break
+        wakeup.wait(min(poll_interval, remaining))
+    if not pending:
+        logging.info(f"Ready after {clock() - start:.1f}s")
+    elif not wakeup.stopped:
+        logging.info(f"Not ready after {timeout:.0f}s: {', '.join(sorted(pending))}, starting anyway")
+    return set(pending)
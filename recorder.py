@@ -0,0 +1,108 @@
+import mmap
+import os
+import struct
+
+MAGIC = b"PMTS"
+VERSION = 1
+CAPACITY = 60 * 24 * 90 # Records kept before the oldest are overwritten, ~3 months at one sample per minute
+
+HEADER = struct.Struct("<4sIIIQQ") # magic, version, capacity, record size, next write index, records written
+RECORD = struct.Struct("<dfffHBb") # time, battery, cpu, memory, gpu processes, plugged, action
+FIELDS = [("time", "<f8"), ("battery", "<f4"), ("cpu", "<f4"), ("memory", "<f4"), ("gpu_processes", "<u2"),
+          ("plugged", "u1"), ("action", "i1")]
+
+NO_ACTION = -1 # Action value of samples after which the plug was not commanded
+
+
+class Recorder:
+    """Fixed-size ring of fixed-width samples stored in a memory-mapped file.
+
+    Appending writes one record in place, so memory and disk usage never grow past `capacity` records. The header
+    keeps the write position, so the history survives restarts. Subclasses store other records by overriding
+    `magic`, `record` and `fields`, whose first field must be the time.
+    """
+
+    magic = MAGIC
+    record = RECORD
+    fields = FIELDS
+
+    def __init__(self, path, capacity=CAPACITY, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        size = HEADER.size + capacity * self.record.size
+        if readonly:
+            self._file = open(path, "rb")
+        else:
+            self._file = open(path, "a+b")
+            if os.fstat(self._file.fileno()).st_size == 0:
+                self._file.truncate(size)
+                self._file.flush()
+                self._map = mmap.mmap(self._file.fileno(), size)
+                HEADER.pack_into(self._map, 0, self.magic, VERSION, capacity, self.record.size, 0, 0)
+                self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        magic, version, self.capacity, record_size, self.head, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != self.magic or version != VERSION or record_size != self.record.size:
+            self.close()
+            raise ValueError(f"{path} is not a version {VERSION} {self.magic.decode()} file")
+
+    def append(self, sample, action=None):
+        gpu_processes = sum(gpu.processes for gpu in sample.gpus)
+        self.write(sample.time, sample.battery, sample.cpu, sample.memory, gpu_processes, sample.plugged,
+                   NO_ACTION if action is None else action)
+
+    def write(self, *values):
+        """Appends one record with the given field values, overwriting the oldest one once the ring is full."""
+        self.record.pack_into(self._map, HEADER.size + (self.head % self.capacity) * self.record.size, *values)
+        self.head += 1
+        self.count = min(self.count + 1, self.capacity)
+        # Only the two counters change, the rest of the header is written once on creation
+        struct.pack_into("<QQ", self._map, HEADER.size - 16, self.head, self.count)
+
+    def read(self, start=None, end=None):
+        """Returns the samples with start <= time < end as a NumPy structured array, in time order.
+
+        The array is a view on the mapped file unless the range spans the point where the ring wraps around, in
+        which case the two halves are joined into a copy. If the clock was set back while recording, the times are
+        no longer sorted and the range is selected with a mask instead, which always returns a copy.
+        """
+        import numpy as np
+
+        dtype = np.dtype(self.fields)
+        _, _, _, _, self.head, self.count = HEADER.unpack_from(self._map, 0)
+        records = np.frombuffer(self._map, dtype=dtype, count=self.capacity, offset=HEADER.size)
+        split = self.head % self.capacity
+        if self.count < self.capacity:
+            segments = [records[:self.count]]
+        else:
+            segments = [records[split:], records[:split]]
+
+        selected = []
+        for segment in segments:
+            if (start is not None or end is not None) and np.any(np.diff(segment["time"]) < 0):
+                times = segment["time"]
+                mask = np.ones(len(segment), dtype=bool)
+                if start is not None:
+                    mask &= times >= start
+                if end is not None:
+                    mask &= times < end
+                if mask.any():
+                    selected.append(segment[mask])
+                continue
+            lo = 0 if start is None else np.searchsorted(segment["time"], start, side="left")
+            hi = len(segment) if end is None else np.searchsorted(segment["time"], end, side="left")
+            if hi > lo:
+                selected.append(segment[lo:hi])
+        if not selected:
+            return records[:0]
+        if len(selected) == 1:
+            return selected[0]
+        return np.concatenate(selected)
+
+    def close(self):
+        if not self._map.closed:
+            if not self.readonly:
+                self._map.flush()
+            # Fails with BufferError while arrays returned by read() are still alive
+            self._map.close()
+        self._file.close()
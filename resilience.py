@@ -0,0 +1,132 @@
+import random
+import time
+from collections import deque
+
+import metrics
+
+BASE_DELAY = 30 # Seconds of the first backoff, doubled after every further failure
+MAX_DELAY = 60 * 30 # Longest backoff, in seconds
+FAILURE_THRESHOLD = 5 # Consecutive failures that open a circuit
+TRIAL_TIMEOUT = 60 # Seconds a half-open circuit waits for the outcome of its trial call before letting another through
+RETRY_BUDGET = 10 # Retries allowed per window
+RETRY_WINDOW = 60 * 60 # Seconds of the retry budget window
+
+CLOSED = "closed"
+HALF_OPEN = "half-open"
+OPEN = "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2} # As exported in metrics
+
+
+class Backoff:
+    """Exponential backoff with full jitter: the n-th delay is drawn uniformly from [0, min(max_delay, base * 2^n)]."""
+
+    def __init__(self, base=BASE_DELAY, max_delay=MAX_DELAY, rng=random):
+        self.base = base
+        self.max_delay = max_delay
+        self.rng = rng
+        self.attempts = 0
+
+    def next(self):
+        ceiling = min(self.max_delay, self.base * 2 ** min(self.attempts, 32))
+        self.attempts += 1
+        return self.rng.uniform(0, ceiling)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class CircuitBreaker:
+    """Stops calls to a plug that keeps failing, and lets a single trial call through once its backoff has passed.
+
+    Closed: calls go through, and `failure_threshold` consecutive failures open the circuit. Open: calls are refused
+    until `retry_at`. Half-open: one trial call goes through, a success closes the circuit and a failure opens it again
+    for a longer backoff. A trial whose outcome is never reported, such as one abandoned by its step, no longer counts
+    after `trial_timeout` seconds and the next call is let through as a new trial.
+    """
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, backoff=None, clock=time.monotonic,
+                 trial_timeout=TRIAL_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.trial_timeout = trial_timeout
+        self.backoff = backoff or Backoff()
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0 # Consecutive failures
+        self.opened = 0 # Times the circuit opened
+        self.retry_at = None
+
+    def _transition(self, state):
+        self.state = state
+        metrics.BREAKER_STATE.set(STATE_VALUES[state])
+        if state == OPEN:
+            self.opened += 1
+            metrics.BREAKER_OPENS.inc()
+            self.retry_at = self.clock() + self.backoff.next()
+        elif state == HALF_OPEN:
+            self.retry_at = self.clock() + self.trial_timeout
+        else:
+            self.retry_at = None
+
+    def allow(self):
+        """Returns True if a call may go through now."""
+        if self.state == OPEN and self.clock() >= self.retry_at:
+            self._transition(HALF_OPEN)
+            return True
+        if self.state == HALF_OPEN and self.clock() >= self.retry_at:
+            # The previous trial never reported back
+            self.retry_at = self.clock() + self.trial_timeout
+            return True
+        return self.state == CLOSED
+
+    def success(self):
+        self.failures = 0
+        self.backoff.reset()
+        if self.state != CLOSED:
+            self._transition(CLOSED)
+
+    def failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self._transition(OPEN)
+
+    def remaining(self):
+        """Seconds until an open circuit lets a trial call through, 0 otherwise."""
+        return max(0.0, self.retry_at - self.clock()) if self.state == OPEN else 0.0
+
+    def status(self):
+        return {"state": self.state, "failures": self.failures, "opened": self.opened,
+                "retry_in": round(self.remaining(), 1)}
+
+
+class RetryBudget:
+    """Allows at most `limit` retries in any `window` seconds."""
+
+    def __init__(self, limit=RETRY_BUDGET, window=RETRY_WINDOW, clock=time.monotonic):
+        self.limit = limit
+        self.window = window
+        self.clock = clock
+        self.denied = 0
+        self._spent = deque()
+
+    def _expire(self):
+        now = self.clock()
+        while self._spent and now - self._spent[0] >= self.window:
+            self._spent.popleft()
+
+    def spend(self):
+        """Takes one retry from the budget. Returns False, taking nothing, if it is exhausted."""
+        self._expire()
+        if len(self._spent) >= self.limit:
+            self.denied += 1
+            metrics.RETRIES_DENIED.inc()
+            return False
+        self._spent.append(self.clock())
+        return True
+
+    def remaining(self):
+        self._expire()
+        return max(0, self.limit - len(self._spent))
+
+    def status(self):
+        return {"remaining": self.remaining(), "limit": self.limit, "window": self.window, "denied": self.denied}
@@ -0,0 +1,79 @@
+import time
+from collections import deque, namedtuple
+import psutil
+
+import metrics
+from steps import DaemonExecutor
+
+LOAD_WINDOW = 5 # Number of samples averaged when deciding if the load is high
+
+Sample = namedtuple("Sample", ["time", "battery", "plugged", "cpu", "memory", "cpu_average", "memory_average", "gpus",
+                               "power", "energy"])
+
+
+class Sampler:
+    """Reads battery, CPU, memory and GPU state concurrently and keeps a rolling window of the load.
+
+    CPU usage comes from the delta since the previous sample, so no reading ever sleeps. `battery` must return a
+    (percent, plugged) tuple or a BatteryReading, whose power (W) and energy (Wh) are kept when known, and `gpu` a
+    list of GpuSample. `cpu`, `memory` and `clock` default to psutil and the wall clock, and are only replaced in
+    simulations.
+    """
+
+    def __init__(self, battery, gpu, window=LOAD_WINDOW, cpu=None, memory=None, clock=time.time):
+        self.battery = battery
+        self.gpu = gpu
+        self.cpu = cpu or (lambda: psutil.cpu_percent(interval=None))
+        self.memory = memory or (lambda: psutil.virtual_memory().percent)
+        self.clock = clock
+        self._cpu = deque(maxlen=window)
+        self._memory = deque(maxlen=window)
+        # Daemon threads, so that a battery read or NVML call that never returns does not hold up the exit
+        self._pool = DaemonExecutor(2, thread_name_prefix="sampler")
+        # The first non-blocking call has no previous reading to compare with and always returns 0
+        self.cpu()
+
+    @property
+    def window(self):
+        return self._cpu.maxlen
+
+    @window.setter
+    def window(self, size):
+        if size != self._cpu.maxlen:
+            self._cpu = deque(self._cpu, maxlen=size)
+            self._memory = deque(self._memory, maxlen=size)
+
+    def cpu_average(self):
+        return sum(self._cpu) / len(self._cpu) if self._cpu else 0.0
+
+    def memory_average(self):
+        return sum(self._memory) / len(self._memory) if self._memory else 0.0
+
+    def _read_battery(self):
+        start = time.perf_counter()
+        reading = self.battery()
+        metrics.BATTERY_READ.observe(time.perf_counter() - start)
+        metrics.BATTERY_LEVEL.set(reading[0])
+        power = getattr(reading, "power", None)
+        if power is not None:
+            metrics.BATTERY_POWER.set(power)
+        return reading
+
+    def sample(self, gpus=None):
+        """Reads every sensor. `gpus` are used instead of calling `gpu` when given, e.g. read under a timeout."""
+        battery = self._pool.submit(self._read_battery)
+        probe = self._pool.submit(self.gpu) if gpus is None else None
+        start = time.perf_counter()
+        cpu = self.cpu()
+        memory = self.memory()
+        metrics.CPU_SAMPLE.observe(time.perf_counter() - start)
+        self._cpu.append(cpu)
+        self._memory.append(memory)
+        reading = battery.result()
+        if probe is not None:
+            gpus = probe.result()
+        return Sample(self.clock(), reading[0], reading[1], cpu, memory, self.cpu_average(), self.memory_average(),
+                      gpus, getattr(reading, "power", None), getattr(reading, "energy", None))
+
+    def close(self):
+        self._pool.shutdown()
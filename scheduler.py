@@ -0,0 +1,54 @@
+import time
+from collections import deque
+
+HISTORY = 10 # Number of battery readings used to estimate the charge/discharge rate
+MARGIN = 0.8 # Fraction of the time left to a threshold that is actually slept, to wake up just before crossing it
+
+
+class SleepScheduler:
+    """Picks the next check time from the battery's rate of change.
+
+    The rate is a least squares fit over the last readings taken with the same plugged state. When discharging the
+    next check is scheduled just before LOW_THRESHOLD is expected to be reached, when charging just before
+    HIGH_THRESHOLD. The result is always clamped to [min_interval, max_interval].
+    """
+
+    def __init__(self, min_interval, max_interval, history=HISTORY):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._readings = deque(maxlen=history)
+        self._plugged = None
+
+    def record(self, level, plugged, now=None):
+        if plugged != self._plugged:
+            # Charging and discharging rates have nothing to do with each other
+            self._readings.clear()
+            self._plugged = plugged
+        self._readings.append((time.monotonic() if now is None else now, level))
+
+    def rate(self):
+        """Battery change in percent per second, or None until there are enough readings."""
+        if len(self._readings) < 2:
+            return None
+        n = len(self._readings)
+        mean_t = sum(t for t, _ in self._readings) / n
+        mean_level = sum(level for _, level in self._readings) / n
+        var = sum((t - mean_t) ** 2 for t, _ in self._readings)
+        if var == 0:
+            return None
+        return sum((t - mean_t) * (level - mean_level) for t, level in self._readings) / var
+
+    def clamp(self, interval):
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def next_interval(self, low, high, default):
+        rate = self.rate()
+        if not rate:
+            return self.clamp(default)
+        level = self._readings[-1][1]
+        target = low if rate < 0 else high
+        remaining = (target - level) / rate
+        if remaining <= 0:
+            # Already past the threshold we are heading to, nothing to predict
+            return self.clamp(default)
+        return self.clamp(remaining * MARGIN)
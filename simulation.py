@@ -0,0 +1,245 @@
+"""Runs the charge policy against fake hardware and a virtual clock, far faster than real time.
+
+    python simulation.py --days 30
+    python simulation.py --history history.bin --low 30 --high 75
+
+The battery, CPU/memory, NVML and tinytuya are replaced by fakes, while the policy, the sampler, the sleep scheduler and
+the plug session are the same code the daemon runs.
+"""
+import argparse
+import math
+import random
+from collections import namedtuple
+
+from gpu_probe import GpuSample
+from plug_session import PlugSession
+from policy import decide, is_consuming
+from sampler import Sampler
+from scheduler import SleepScheduler
+
+STEP = 60 # Seconds between two points of a trace
+CHARGE_RATE = 100 / (90 * 60) # Percent per second while plugged, a full charge in an hour and a half
+IDLE_DRAIN = 100 / (8 * 60 * 60) # Percent per second while unplugged and idle, eight hours of battery
+LOAD_DRAIN = 100 / (2 * 60 * 60) # Extra percent per second at 100% CPU
+
+Trace = namedtuple("Trace", ["start", "step", "cpu", "memory", "gpu_processes"])
+Report = namedtuple("Report", ["simulated", "iterations", "commands", "status_queries", "suppressed", "toggles",
+                               "below_low", "above_high", "min_level", "max_level"])
+
+
+def synthetic_trace(days, step=STEP, seed=0):
+    """Office hours with random load, a few heavy bursts and GPU jobs, and idle nights."""
+    rng = random.Random(seed)
+    cpu, memory, gpu_processes = [], [], []
+    burst = 0
+    gpu_job = 0
+    for i in range(int(days * 24 * 60 * 60 / step)):
+        hour = (i * step / 3600) % 24
+        working = 9 <= hour < 18
+        if working and burst == 0 and rng.random() < 0.005:
+            burst = rng.randint(10, 60) * 60 // step
+        if working and gpu_job == 0 and rng.random() < 0.002:
+            gpu_job = rng.randint(30, 120) * 60 // step
+        base = 25 + 15 * math.sin(math.pi * (hour - 9) / 9) if working else 3
+        cpu.append(min(100.0, 95.0 if burst else max(0.0, rng.gauss(base, 8))))
+        memory.append(min(100.0, 85.0 if burst else max(0.0, rng.gauss(40 if working else 20, 5))))
+        gpu_processes.append(2 if gpu_job else 0)
+        burst = max(0, burst - 1)
+        gpu_job = max(0, gpu_job - 1)
+    return Trace(0.0, step, cpu, memory, gpu_processes)
+
+
+def recorded_trace(path, step=STEP):
+    """Load of the samples stored by the daemon in history.bin, resampled every `step` seconds."""
+    import numpy as np
+
+    from recorder import Recorder
+
+    history = Recorder(path, readonly=True)
+    records = history.read().copy()
+    history.close()
+    if len(records) < 2:
+        raise ValueError(f"{path} holds fewer than two samples")
+    grid = np.arange(records["time"][0], records["time"][-1], step)
+    cpu = np.interp(grid, records["time"], records["cpu"])
+    memory = np.interp(grid, records["time"], records["memory"])
+    # Process counts are not interpolated, each point takes the last recorded value
+    last = np.searchsorted(records["time"], grid, side="right") - 1
+    return Trace(float(grid[0]), step, cpu.tolist(), memory.tolist(), records["gpu_processes"][last].tolist())
+
+
+class VirtualClock:
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+
+class FakeBattery:
+    """Charges at a fixed rate while the plug is on, and drains faster the higher the CPU load."""
+
+    def __init__(self, level=60.0, charge_rate=CHARGE_RATE, idle_drain=IDLE_DRAIN, load_drain=LOAD_DRAIN):
+        self.level = level
+        self.plugged = False
+        self.charge_rate = charge_rate
+        self.idle_drain = idle_drain
+        self.load_drain = load_drain
+
+    def advance(self, seconds, cpu):
+        rate = self.charge_rate if self.plugged else -(self.idle_drain + self.load_drain * cpu / 100)
+        self.level = min(100.0, max(0.0, self.level + rate * seconds))
+
+    def read(self):
+        return round(self.level), self.plugged
+
+
+class FakeLoad:
+    """CPU, memory and NVML readings taken from a trace at the current virtual time."""
+
+    def __init__(self, trace, clock):
+        self.trace = trace
+        self.clock = clock
+
+    def index(self):
+        return min(len(self.trace.cpu) - 1, max(0, int((self.clock() - self.trace.start) // self.trace.step)))
+
+    def cpu(self):
+        return self.trace.cpu[self.index()]
+
+    def memory(self):
+        return self.trace.memory[self.index()]
+
+    def gpus(self):
+        return [GpuSample(0, self.trace.gpu_processes[self.index()], None, 0, 0)]
+
+
+class FakeOutlet:
+    """Stands in for tinytuya.OutletDevice, the relay powers the battery charger."""
+
+    socket = None
+
+    def __init__(self, battery):
+        self.battery = battery
+        self.commands = 0
+        self.status_queries = 0
+        self.toggles = 0
+
+    def set_status(self, on, switch='1'):
+        self.commands += 1
+        if self.battery.plugged != on:
+            self.toggles += 1
+        self.battery.plugged = on
+        return {'dps': {switch: on}}
+
+    def status(self):
+        self.status_queries += 1
+        return {'dps': {'1': self.battery.plugged}}
+
+    def heartbeat(self, nowait=True):
+        pass
+
+    def close(self):
+        pass
+
+
+class Simulation:
+    def __init__(self, trace, low_threshold=25, high_threshold=80, gpu_process_threshold=1, sleep_time=60,
+                 min_sleep_time=10, max_sleep_time=600, load_window=5, verify_interval=600,
+                 consuming_keeps_plug=True, battery=None, load_threshold=80):
+        self.trace = trace
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+        self.gpu_process_threshold = gpu_process_threshold
+        self.load_threshold = load_threshold
+        self.sleep_time = sleep_time
+        self.consuming_keeps_plug = consuming_keeps_plug
+        self.clock = VirtualClock(trace.start)
+        self.battery = battery or FakeBattery()
+        self.load = FakeLoad(trace, self.clock)
+        self.outlet = FakeOutlet(self.battery)
+        self.sampler = Sampler(self.battery.read, self.load.gpus, load_window, cpu=self.load.cpu,
+                               memory=self.load.memory, clock=self.clock)
+        self.scheduler = SleepScheduler(min_sleep_time, max_sleep_time)
+        self.plug = PlugSession("simulated", lambda: {}, verify_interval=verify_interval,
+                                factory=lambda config: self.outlet, clock=self.clock)
+        self.iterations = 0
+        self.below_low = 0.0
+        self.above_high = 0.0
+        self.min_level = self.battery.level
+        self.max_level = self.battery.level
+
+    @property
+    def end(self):
+        return self.trace.start + len(self.trace.cpu) * self.trace.step
+
+    def _advance(self, seconds):
+        """Moves the clock forward, integrating the battery over the trace points in between."""
+        target = min(self.end, self.clock.now + seconds)
+        while self.clock.now < target:
+            next_point = self.trace.start + (self.load.index() + 1) * self.trace.step
+            dt = min(target, next_point) - self.clock.now
+            self.battery.advance(dt, self.load.cpu())
+            self.clock.now += dt
+            level = self.battery.level
+            self.min_level = min(self.min_level, level)
+            self.max_level = max(self.max_level, level)
+            if level < self.low_threshold:
+                self.below_low += dt
+            elif level > self.high_threshold:
+                self.above_high += dt
+
+    def step(self):
+        sample = self.sampler.sample()
+        self.scheduler.record(sample.battery, sample.plugged, now=self.clock.now)
+        consuming = is_consuming(sample, self.gpu_process_threshold, self.load_threshold)
+        action = decide(sample.battery, sample.plugged, consuming, self.low_threshold, self.high_threshold,
+                        self.consuming_keeps_plug)
+        if action is not None:
+            self.plug.ensure(action, sample.plugged)
+        self.iterations += 1
+        return self.scheduler.next_interval(self.low_threshold, self.high_threshold, self.sleep_time)
+
+    def run(self):
+        try:
+            while self.clock.now < self.end:
+                self._advance(self.step())
+        finally:
+            self.sampler.close()
+            self.plug.close()
+        return Report(self.clock.now - self.trace.start, self.iterations, self.outlet.commands,
+                      self.outlet.status_queries, self.plug.suppressed, self.outlet.toggles, self.below_low,
+                      self.above_high, self.min_level, self.max_level)
+
+
+def print_report(report):
+    hours = report.simulated / 3600
+    print(f"Simulated:        {hours:.1f} h in {report.iterations} checks")
+    print(f"Plug toggles:     {report.toggles}")
+    print(f"Commands sent:    {report.commands} (+{report.status_queries} status queries, {report.suppressed} suppressed)")
+    print(f"Below low:        {report.below_low / 3600:.2f} h")
+    print(f"Above high:       {report.above_high / 3600:.2f} h")
+    print(f"Battery range:    {report.min_level:.1f}% - {report.max_level:.1f}%")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate the charge policy on a synthetic or recorded trace")
+    parser.add_argument("--days", type=float, default=7, help="length of the synthetic trace")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic trace")
+    parser.add_argument("--history", help="replay the load recorded in this history.bin instead")
+    parser.add_argument("--low", type=float, default=25, help="LOW_THRESHOLD")
+    parser.add_argument("--high", type=float, default=80, help="HIGH_THRESHOLD")
+    parser.add_argument("--load-threshold", type=float, default=80, help="LOAD_THRESHOLD")
+    parser.add_argument("--load-window", type=int, default=5, help="LOAD_WINDOW")
+    parser.add_argument("--sleep-time", type=float, default=60, help="SLEEP_TIME")
+    parser.add_argument("--min-sleep-time", type=float, default=10, help="MIN_SLEEP_TIME")
+    parser.add_argument("--max-sleep-time", type=float, default=600, help="MAX_SLEEP_TIME")
+    parser.add_argument("--windows", action="store_true", help="use the policy of powermonitor_win.py")
+    args = parser.parse_args()
+
+    trace = recorded_trace(args.history) if args.history else synthetic_trace(args.days, seed=args.seed)
+    simulation = Simulation(trace, args.low, args.high, sleep_time=args.sleep_time,
+                            min_sleep_time=args.min_sleep_time, max_sleep_time=args.max_sleep_time,
+                            load_window=args.load_window, consuming_keeps_plug=not args.windows,
+                            load_threshold=args.load_threshold)
+    print_report(simulation.run())
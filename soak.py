@@ -0,0 +1,328 @@
+"""Soak test of the monitoring loop: millions of iterations on fake hardware and a virtual clock, watching for leaks.
+
+    python soak.py --iterations 1000000
+    python soak.py --iterations 200000 --no-tracemalloc
+
+The loop is the daemon's own: monitorer.monitor() runs on an asyncio event loop and calls monitorer.check() for every
+iteration, with the fakes of the simulation put in the globals of monitorer in place of the battery, CPU/memory, NVML,
+tinytuya and the network scans, and a virtual clock in place of its clock. Parameters, devices and ring files live in a
+temporary directory, which is also the working directory monitorer is imported from, so its log goes there too. The
+ring files are small, so they wrap around.
+
+The wait between two iterations moves the virtual clock instead of sleeping. Every so often parameters.json is
+rewritten, switching ALWAYS_ON on and off, HOLD is overridden through the control server, a status request is answered
+and the metrics are rendered. The plug fails every so often, so the session reconnects, the circuit breaker and the
+retry budget are spent and devices.json is read again, and the NVML probe overruns its timeout every so often, so it
+is abandoned and refused once.
+
+RSS, open file descriptors and the heap traced by tracemalloc are measured at regular checkpoints. The test fails if
+any of them grew past its tolerance between the end of the warm-up and the last checkpoint, or if a file or socket
+was ever left for the garbage collector to close (a ResourceWarning). The allocation sites that grew the most are
+listed on failure.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from collections import namedtuple
+from types import SimpleNamespace
+
+import psutil
+
+import metrics
+from config_watcher import ConfigWatcher
+from device_registry import DeviceRegistry
+from metering import EnergyLedger, MeterRecorder
+from recorder import Recorder
+from resilience import RetryBudget
+from sampler import Sampler
+from simulation import FakeBattery, FakeLoad, FakeOutlet, VirtualClock, synthetic_trace
+from steps import Steps
+from wakeup import Wakeup
+
+ITERATIONS = 1000000
+CHECKPOINTS = 20 # Measurements taken over the run
+WARMUP = 0.2 # Fraction of the iterations after which caches and rings are expected to be full
+RING_CAPACITY = 1000 # Records of the ring files, small so they wrap around many times
+FAILURE_EVERY = 97 # Plug commands between two simulated failures
+RELOAD_EVERY = 1000 # Iterations between two rewrites of parameters.json
+OVERRIDE_EVERY = 1500 # Iterations between two HOLD overrides
+HOLD_FOR = 10 # Iterations a HOLD override lasts before it is cleared
+STATUS_EVERY = 100 # Iterations between two status requests and metric renders
+OVERRUN_EVERY = 1000 # NVML probes between two that overrun their timeout
+OVERRUN_TIMEOUT = 0.01 # Seconds allowed to the NVML probe
+OVERRUN_TIME = 0.02 # Seconds the probe that overruns takes, it is still running at the next iteration
+MAX_RSS_GROWTH = 8 * 1024 * 1024 # Bytes
+MAX_HEAP_GROWTH = 512 * 1024 # Bytes
+MAX_FD_GROWTH = 0
+
+Checkpoint = namedtuple("Checkpoint", ["iteration", "rss", "fds", "heap"])
+
+
+class CyclicLoad(FakeLoad):
+    """Replays the trace over and over, however long the virtual clock runs.
+
+    Every `overrun_every`-th NVML probe takes `overrun_time` seconds, longer than the loop allows it.
+    """
+
+    def __init__(self, trace, clock, overrun_every=OVERRUN_EVERY, overrun_time=OVERRUN_TIME):
+        super().__init__(trace, clock)
+        self.overrun_every = overrun_every
+        self.overrun_time = overrun_time
+        self.probes = 0
+
+    def index(self):
+        return int((self.clock() - self.trace.start) // self.trace.step) % len(self.trace.cpu)
+
+    def gpus(self):
+        self.probes += 1
+        if self.probes % self.overrun_every == 0:
+            time.sleep(self.overrun_time)
+        return super().gpus()
+
+
+class FakeDiscovery:
+    """Stands in for discovery.Rediscovery, the plug is always found at the address devices.json gives."""
+
+    def __init__(self):
+        self.scan_time = 0
+        self.ttl = 0
+        self.scans = 0
+
+    def find(self, dev_id, last_ip=None):
+        return last_ip
+
+    def scan_all(self):
+        return {}
+
+
+class SoakWakeup(Wakeup):
+    """Ends every wait of the loop at once, after `on_wait(timeout)` moved the fakes by the time it would have slept."""
+
+    def __init__(self, on_wait):
+        super().__init__()
+        self.on_wait = on_wait
+
+    def wait(self, timeout):
+        self.on_wait(timeout)
+        # What woke the loop up in the meantime, such as a new parameters.json or an override
+        return super().wait(0)
+
+
+class FlakyOutlet(FakeOutlet):
+    """Fake plug that answers every `failure_every`-th request with an error, and meters the charger."""
+
+    def __init__(self, battery, failure_every=FAILURE_EVERY):
+        super().__init__(battery)
+        self.failure_every = failure_every
+        self.requests = 0
+
+    def _reply(self, dps):
+        self.requests += 1
+        if self.requests % self.failure_every == 0:
+            return {'Error': 'Network Error: Device Unreachable'}
+        dps.update({'18': 2100 if self.battery.plugged else 0, '19': 450 if self.battery.plugged else 0,
+                    '20': 2300})
+        return {'dps': dps}
+
+    def set_status(self, on, switch='1'):
+        return self._reply(super().set_status(on, switch)['dps'])
+
+    def status(self):
+        return self._reply(super().status()['dps'])
+
+
+class ResourceWarnings:
+    """Counts the files and sockets closed by the garbage collector instead of the code that opened them."""
+
+    def __init__(self):
+        self.count = 0
+        self.first = None
+
+    def __enter__(self):
+        self._catcher = warnings.catch_warnings()
+        self._catcher.__enter__()
+        warnings.simplefilter("always", ResourceWarning)
+        self._show = warnings.showwarning
+        warnings.showwarning = self._record
+        return self
+
+    def _record(self, message, category, filename, lineno, file=None, line=None):
+        if not issubclass(category, ResourceWarning):
+            self._show(message, category, filename, lineno, file, line)
+            return
+        self.count += 1
+        if self.first is None:
+            self.first = f"{filename}:{lineno}: {message}"
+
+    def __exit__(self, *exc):
+        self._catcher.__exit__(*exc)
+
+
+def open_fds(process):
+    return process.num_handles() if os.name == "nt" else process.num_fds()
+
+
+def write_json(path, value):
+    with open(path, "w") as f:
+        json.dump(value, f)
+
+
+class SoakDaemon:
+    """monitorer with its hardware, network and clock replaced by fakes, stopped after `iterations` iterations.
+
+    `checkpoint(i)` is called after iteration `i`, in the wait that follows it.
+    """
+
+    def __init__(self, monitorer, directory, iterations, checkpoint, seed=0):
+        self.monitorer = monitorer
+        self.iterations = iterations
+        self.checkpoint = checkpoint
+        self.iteration = 0
+        self.clock = VirtualClock()
+        self.battery = FakeBattery()
+        self.load = CyclicLoad(synthetic_trace(1, seed=seed), self.clock)
+        self.outlet = FlakyOutlet(self.battery)
+        self.parameters_path = os.path.join(directory, "parameters.json")
+        devices_path = os.path.join(directory, "devices.json")
+        write_json(devices_path, [{"name": "soak", "id": "0", "ip": "127.0.0.1", "key": ""}])
+        self.write_parameters(0)
+
+        monitorer.WAKEUP = SoakWakeup(self.tick)
+        monitorer.WATCHER = ConfigWatcher(self.parameters_path, changed=monitorer.WAKEUP)
+        monitorer.WATCHER.check()
+        monitorer.REGISTRY = DeviceRegistry(devices_path, clock=self.clock)
+        monitorer.DISCOVERY = FakeDiscovery()
+        monitorer.GPU = SimpleNamespace(sample=self.load.gpus)
+        monitorer.SAMPLER = Sampler(self.battery.read, self.load.gpus, cpu=self.load.cpu, memory=self.load.memory,
+                                    clock=self.clock)
+        monitorer.PLUG_FACTORY = lambda config: self.outlet
+        monitorer.CLOCK = monitorer.WALL_CLOCK = self.clock
+        monitorer.BUDGET = RetryBudget(monitorer.RETRY_BUDGET, clock=self.clock)
+        monitorer.STEPS.close()
+        monitorer.STEPS = Steps(monitorer.ITERATION_DEADLINE,
+                                timeouts={"sensors": 5, "nvml": OVERRUN_TIMEOUT, "plug": 15, "discovery": 5})
+        monitorer.RECORDER = Recorder(os.path.join(directory, "history.bin"), RING_CAPACITY)
+        monitorer.METER = MeterRecorder(os.path.join(directory, "metering.bin"), RING_CAPACITY)
+        monitorer.LEDGER = EnergyLedger(os.path.join(directory, "energy_ledger.jsonl"))
+        monitorer.CONTROL.command("status", monitorer.status)
+
+    def write_parameters(self, reloads):
+        # A different value every time, so the watcher has something to apply, and ALWAYS_ON one time in four
+        write_json(self.parameters_path, {"DEVICE_NAME": "soak", "SLEEP_TIME": 60 + reloads % 2,
+                                          "ALWAYS_ON": reloads % 4 == 3})
+
+    def tick(self, timeout):
+        self.battery.advance(timeout, self.load.cpu())
+        self.clock.now += timeout
+        self.iteration += 1
+        i = self.iteration
+        control = self.monitorer.CONTROL
+        if i % RELOAD_EVERY == 0:
+            self.write_parameters(i // RELOAD_EVERY)
+            self.monitorer.WATCHER.check()
+        if i % OVERRIDE_EVERY == 0:
+            control.handle({"command": "set", "arguments": {"name": "HOLD", "value": True}})
+        elif i % OVERRIDE_EVERY == HOLD_FOR:
+            control.handle({"command": "clear"})
+        if i % STATUS_EVERY == 0:
+            json.dumps(control.handle({"command": "status"}), default=str)
+            metrics.render()
+        self.checkpoint(i)
+        if i >= self.iterations:
+            self.monitorer.WAKEUP.stop()
+
+    def close(self):
+        # Turns the plug off and closes the plug session, the steps and the ring files, as the daemon does on exit
+        self.monitorer.on_shutdown()
+        self.monitorer.SAMPLER.close()
+        self.monitorer.LOGGER.stop()
+
+
+def soak(iterations=ITERATIONS, checkpoints=CHECKPOINTS, trace=True, seed=0):
+    """Runs the loop and returns the checkpoints, the ResourceWarnings raised and the heap growth by allocation site."""
+    process = psutil.Process()
+    if trace:
+        tracemalloc.start(1)
+    taken = []
+    baseline = final = None
+    every = max(1, iterations // checkpoints)
+    warmup = int(iterations * WARMUP)
+
+    def checkpoint(i):
+        nonlocal baseline, final
+        if i % every and i != iterations:
+            return
+        heap = tracemalloc.get_traced_memory()[0] if trace else 0
+        taken.append(Checkpoint(i, process.memory_info().rss, open_fds(process), heap))
+        if trace and baseline is None and i >= warmup:
+            baseline = tracemalloc.take_snapshot()
+        if trace and i == iterations:
+            final = tracemalloc.take_snapshot()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory, ResourceWarnings() as leaked:
+        # monitorer opens its log and looks for its files in the working directory it is imported from
+        os.chdir(directory)
+        try:
+            import monitorer
+
+            daemon = SoakDaemon(monitorer, directory, iterations, checkpoint, seed)
+            try:
+                asyncio.run(monitorer.monitor())
+            finally:
+                daemon.close()
+        finally:
+            os.chdir(cwd)
+    if trace:
+        tracemalloc.stop()
+    growth = final.compare_to(baseline, "lineno") if trace and baseline is not None else []
+    return taken, leaked, growth
+
+
+def check(taken, leaked, warmup=WARMUP):
+    """Returns the reasons the soak failed, an empty list if it passed."""
+    after_warmup = [checkpoint for checkpoint in taken if checkpoint.iteration >= taken[-1].iteration * warmup]
+    first, last = after_warmup[0], after_warmup[-1]
+    failures = []
+    if last.rss - first.rss > MAX_RSS_GROWTH:
+        failures.append(f"RSS grew by {(last.rss - first.rss) / 1024:.0f} KiB")
+    if last.fds - first.fds > MAX_FD_GROWTH:
+        failures.append(f"open file descriptors grew by {last.fds - first.fds}")
+    if last.heap - first.heap > MAX_HEAP_GROWTH:
+        failures.append(f"traced heap grew by {(last.heap - first.heap) / 1024:.0f} KiB")
+    if leaked.count:
+        failures.append(f"{leaked.count} files or sockets closed by the garbage collector, first: {leaked.first}")
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the monitoring loop on fakes for a long time and watch for leaks")
+    parser.add_argument("--iterations", type=int, default=ITERATIONS, help="iterations of the loop")
+    parser.add_argument("--checkpoints", type=int, default=CHECKPOINTS, help="measurements over the run")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic load")
+    parser.add_argument("--no-tracemalloc", action="store_true",
+                        help="do not trace the heap, runs about four times as fast")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    taken, leaked, growth = soak(args.iterations, args.checkpoints, not args.no_tracemalloc, args.seed)
+    elapsed = time.perf_counter() - start
+    print(f"{args.iterations} iterations in {elapsed:.1f}s ({elapsed / args.iterations * 1e6:.1f} us each)")
+    print(f"{'iteration':>10} {'RSS KiB':>10} {'fds':>5} {'heap KiB':>10}")
+    for checkpoint in taken:
+        print(f"{checkpoint.iteration:>10} {checkpoint.rss / 1024:>10.0f} {checkpoint.fds:>5} "
+              f"{checkpoint.heap / 1024:>10.0f}")
+    failures = check(taken, leaked)
+    if failures:
+        for failure in failures:
+            print(f"FAILED: {failure}")
+        for stat in growth[:10]:
+            print(f"  {stat}")
+        sys.exit(1)
+    print("No growth after warm-up")
@@ -0,0 +1,167 @@
+"""Deadline-bounded steps of the monitoring loop.
+
+The loop runs as a coroutine on an asyncio event loop, and every step that can block (sensors, NVML, plug commands,
+discovery) runs on a worker thread under its own timeout and under the deadline of the iteration. A step that overruns
+is abandoned: its thread is left to finish in the background, the loop carries on without its result, and the overrun
+is counted. The next call of the same step is refused until the abandoned one returned, so a hung plug or driver ties
+up at most one worker per step and never the loop itself. Workers are daemon threads: one still stuck in a step when
+the daemon exits is left behind instead of holding up the exit.
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+ITERATION_DEADLINE = 60 # Seconds an iteration of the loop may take in total, sleep excluded
+DEFAULT_TIMEOUT = 10 # Seconds allowed to a step without its own timeout
+# Seconds allowed to each step. Plug commands include the connection attempts made by tinytuya, discovery gets
+# SCAN_TIME on top of its own timeout.
+TIMEOUTS = {
+    "sensors": 5,
+    "nvml": 5,
+    "plug": 15,
+    "discovery": 5,
+}
+
+
+class StepTimeout(Exception):
+    pass
+
+
+class DaemonExecutor:
+    """Runs calls on up to `max_workers` daemon threads, started as they are needed.
+
+    Unlike the workers of a ThreadPoolExecutor, which the interpreter joins on exit even after shutdown(), a thread
+    stuck in a call does not keep the process alive.
+    """
+
+    def __init__(self, max_workers, thread_name_prefix="worker"):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._tasks = queue.SimpleQueue()
+        self._threads = []
+        self._pending = 0 # Calls queued or running
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args):
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("cannot run steps after close()")
+            self._pending += 1
+            if self._pending > len(self._threads) and len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work, name=f"{self.thread_name_prefix}_{len(self._threads)}",
+                                          daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        self._tasks.put((future, function, args))
+        return future
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            future, function, args = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args))
+                except BaseException as err:
+                    future.set_exception(err)
+            # Drops the references to the call before waiting for the next one
+            del task, future, function, args
+            with self._lock:
+                self._pending -= 1
+
+    def shutdown(self):
+        """Stops the idle workers once the queued calls are done, without waiting for them."""
+        with self._lock:
+            self._closed = True
+            for _ in self._threads:
+                self._tasks.put(None)
+
+
+class Steps:
+    """Runs the blocking steps of an iteration with `run(name, function, *args)`.
+
+    `begin()` starts the deadline of an iteration. A step may use up to its timeout in `timeouts`, and never more than
+    what is left of the deadline. Steps sharing a name share their timeout, and only one of them is in flight at a time.
+    """
+
+    def __init__(self, deadline=ITERATION_DEADLINE, timeouts=None, default_timeout=DEFAULT_TIMEOUT,
+                 clock=time.monotonic):
+        self.deadline = deadline
+        self.timeouts = dict(TIMEOUTS if timeouts is None else timeouts)
+        self.default_timeout = default_timeout
+        self.clock = clock
+        self.overruns = {} # Per step, timeouts and calls refused while an earlier one was still running
+        self._ends = None
+        self._running = {}
+        # One worker per step that may be stuck, plus one so the others always find a free thread
+        self._executor = DaemonExecutor(len(self.timeouts) + 2, thread_name_prefix="step")
+
+    def begin(self):
+        self._ends = self.clock() + self.deadline
+
+    def remaining(self):
+        """Seconds left before the deadline of the current iteration."""
+        return self.deadline if self._ends is None else self._ends - self.clock()
+
+    def _overrun(self, name, message):
+        self.overruns[name] = self.overruns.get(name, 0) + 1
+        metrics.STEP_OVERRUNS.inc()
+        logging.info(message)
+        raise StepTimeout(message)
+
+    async def run(self, name, function, *args, timeout=None):
+        """Runs `function(*args)` on a worker thread and returns its result.
+
+        Raises StepTimeout if it took too long, if the iteration has no time left, or if the previous call of the step
+        is still running. `timeout` replaces the timeout of the step for this call.
+        """
+        if self.busy(name):
+            self._overrun(name, f"Skipping {name}, still running from an earlier iteration")
+        self._running.pop(name, None)
+        timeout = min(self.timeouts.get(name, self.default_timeout) if timeout is None else timeout, self.remaining())
+        if timeout <= 0:
+            self._overrun(name, f"Skipping {name}, the iteration ran out of time")
+        future = self._executor.submit(function, *args)
+        waiter = asyncio.wrap_future(future)
+        start = self.clock()
+        try:
+            # shield() keeps wait_for from cancelling the future, which could not stop the thread anyway
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            # Whatever the step ends with is of no use any more, it is only retrieved so asyncio does not report it
+            waiter.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self._running[name] = future
+            self._overrun(name, f"{name} did not finish in {self.clock() - start:.1f}s, left running")
+
+    async def optional(self, name, function, *args, default=None, timeout=None):
+        """Like `run`, but returns `default` instead of raising StepTimeout."""
+        try:
+            return await self.run(name, function, *args, timeout=timeout)
+        except StepTimeout:
+            return default
+
+    async def wait(self, wakeup, timeout):
+        """Sleeps on `wakeup` without blocking the event loop, returns the reasons it was woken up for."""
+        return await asyncio.get_running_loop().run_in_executor(None, wakeup.wait, timeout)
+
+    def busy(self, name):
+        """True while a call of the step that overran is still running."""
+        running = self._running.get(name)
+        return running is not None and not running.done()
+
+    def status(self):
+        return {"deadline": self.deadline, "timeouts": dict(self.timeouts), "overruns": dict(self.overruns),
+                "running": sorted(name for name in self._running if self.busy(name))}
+
+    def close(self):
+        """Stops the workers. A step still running is left to finish, or not, on its daemon thread."""
+        self._executor.shutdown()
@@ -0,0 +1,139 @@
+import logging
+import select
+import socket
+import sys
+import threading
+
+NETLINK_KOBJECT_UEVENT = 15
+KERNEL_GROUP = 1 # Multicast group of the uevents sent by the kernel, udev rebroadcasts them on group 2
+RECEIVE_SIZE = 8192
+STOP_CHECK_INTERVAL = 1 # Seconds between checks of the stop flag while no uevent arrives
+
+# Properties of a power supply whose change is worth waking up for. Batteries also send uevents as they (dis)charge,
+# those only change the capacity and are left to the regular checks.
+WATCHED_PROPERTIES = ("POWER_SUPPLY_ONLINE", "POWER_SUPPLY_STATUS")
+
+
+class Wakeup:
+    """Interruptible sleep of the monitor loop.
+
+    Anything can wake the loop with `set(reason)`: a parameters.json change, a power supply event or a stop request.
+    `set` has the signature of threading.Event.set, so a Wakeup can stand in for the event of a ConfigWatcher.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._reasons = set()
+        self.stopped = False
+
+    def set(self, reason="parameters"):
+        with self._condition:
+            self._reasons.add(reason)
+            self._condition.notify_all()
+
+    def clear(self):
+        with self._condition:
+            self._reasons.clear()
+
+    def stop(self):
+        with self._condition:
+            self.stopped = True
+            self._condition.notify_all()
+
+    def wait(self, timeout):
+        """Sleeps up to `timeout` seconds and returns the reasons it was woken up for, empty on timeout."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._reasons or self.stopped, timeout)
+            reasons, self._reasons = self._reasons, set()
+        return reasons
+
+    def sleep(self, seconds):
+        """Sleeps `seconds`, returning early only to stop. Returns False if stopped."""
+        with self._condition:
+            return not self._condition.wait_for(lambda: self.stopped, seconds)
+
+
+def _parse_uevent(data):
+    """Splits a kernel uevent ("ACTION@DEVPATH\\0KEY=VALUE\\0...") into its properties."""
+    properties = {}
+    for field in data.split(b"\0")[1:]:
+        key, sep, value = field.partition(b"=")
+        if sep:
+            properties[key.decode(errors="replace")] = value.decode(errors="replace")
+    return properties
+
+
+class PowerSupplyEvents:
+    """Wakes the loop with the reason "power_supply" as soon as an adapter is plugged or unplugged.
+
+    Listens to the kernel uevents of the power_supply subsystem on a netlink socket, so it only works on Linux. Where
+    the socket cannot be opened it does nothing and the loop keeps polling.
+    """
+
+    def __init__(self, wakeup):
+        self.wakeup = wakeup
+        self.events = 0
+        self._last = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _open(self):
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        except (OSError, AttributeError) as err:
+            logging.info(f"Power supply events not available: {err}")
+            return None
+        try:
+            sock.bind((0, KERNEL_GROUP))
+        except OSError as err:
+            logging.info(f"Power supply events not available: {err}")
+            sock.close()
+            return None
+        return sock
+
+    def handle(self, data):
+        """Returns True, and wakes the loop, if the uevent changes the state of a power supply."""
+        properties = _parse_uevent(data)
+        if properties.get("SUBSYSTEM") != "power_supply":
+            return False
+        name = properties.get("POWER_SUPPLY_NAME", properties.get("DEVPATH"))
+        state = tuple(properties.get(key) for key in WATCHED_PROPERTIES)
+        if self._last.get(name) == state:
+            return False
+        self._last[name] = state
+        self.events += 1
+        logging.info(f"Power supply {name} changed: " + ", ".join(
+            f"{key[len('POWER_SUPPLY_'):].lower()} {value}" for key, value in zip(WATCHED_PROPERTIES, state)
+            if value is not None))
+        self.wakeup.set("power_supply")
+        return True
+
+    def _run(self, sock):
+        try:
+            while not self._stop.is_set():
+                ready, _, _ = select.select([sock], [], [], STOP_CHECK_INTERVAL)
+                if not ready:
+                    continue
+                try:
+                    data = sock.recv(RECEIVE_SIZE)
+                except OSError as err:
+                    # ENOBUFS when events came faster than they were read, the next ones are still received
+                    logging.info(f"Lost power supply events: {err}")
+                    continue
+                self.handle(data)
+        finally:
+            sock.close()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        sock = self._open()
+        if sock is None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(sock,), name="power-events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()